@@ -33,6 +33,18 @@
 #       doc = parseString( xml.etree.ElmentTree.tostring(xml) )
 #       xml_string = doc.toprettyxml('  ')
 #
+# For large databases the xml can instead be written to a file as each
+# top level object is finished, rather than being built up in memory:
+#       with open('dump.xml', 'wb') as f:
+#           serializable.models_to_xml_stream([TopLevelModelClass1], f)
+#
+# To load a dump from a file without reading all of it into memory:
+#       serializable.xml_stream_to_models('dump.xml')
+#
+# Either function can write a more compact form of the xml, with a line
+# of comma separated values per object, by passing compact=True. It is
+# loaded in the same way.
+#
 # In order to delete all the data in memory (in preparation for reloading it,
 # presumably):
 #       delete_all_models_in_db([TopLevelModelClass1, Class2])
@@ -52,21 +64,38 @@
 
 
 import base64
+import collections
+import contextlib
 import copy
 import datetime
 import dateutil.parser
+import decimal
+import hashlib
 import itertools
+import json
 import logging
+import multiprocessing
 import re
 import sys
+import time
+import uuid
 from   xml.etree import ElementTree as ET
 
-from   django.db import models
-from   django.db.models.fields.related \
-                import ReverseManyRelatedObjectsDescriptor
+import django
+import django.apps
+from   django.core.management.color import no_style
+from   django.db import DEFAULT_DB_ALIAS, connection, connections, models, \
+                         transaction
 import django.utils.timezone
 
-from   utils import LoggingFilterContext
+from   utils import LoggingFilterContext, xml_to_string
+
+
+# Number of objects whose owned models are fetched with a single query.
+_PREFETCH_BATCH_SIZE = 500
+
+# Number of rows inserted by each bulk_create when loading with bulk=True.
+_BULK_BATCH_SIZE = 500
 
 
 def _etn(tag, text=None, tail=None, **attribs):
@@ -89,14 +118,33 @@ def _datetime_to_str(dt):
     return 'datetime(%s%s)' % ( ','.join(map(str,vals))
                               , ',UTC' if dt.tzinfo else '')
 
+_DATETIME_RE = re.compile('datetime\(((\d+,){5,6}\d+)(,UTC)?\)')
+
 def _str_to_datetime(dt):
     # dateutil.parser.parse(datetime.datetime.now().isoformat())
-    m=re.match('datetime\(((\d+,){5,6}\d+)(,UTC)?\)',dt)
+    m=_DATETIME_RE.match(dt)
     assert m
     tzinfo = None if not m.group(3) else django.utils.timezone.utc
     return datetime.datetime( *map(int,m.group(1).split(',')), tzinfo=tzinfo )
 
 
+def _str_to_date(d):
+    return datetime.date(*[int(x) for x in d.split('-')])
+
+
+_TIME_RE = re.compile('(\d+):(\d+):(\d+)(?:\.(\d+))?$')
+
+def _str_to_time(t):
+    m=_TIME_RE.match(t)
+    assert m, t
+    return datetime.time( int(m.group(1)), int(m.group(2)), int(m.group(3))
+                        , int(m.group(4) or 0) )
+
+
+def _str_to_bool(b):
+    return {'True':True, 'False':False}[b]
+
+
 def _get_class_from_class_pathname(class_pathname):
     cls_module,cls_name = class_pathname.rsplit('.', 1)
     if cls_module not in sys.modules:
@@ -107,6 +155,137 @@ def _get_class_from_class_pathname(class_pathname):
     return sys.modules[cls_module].__dict__[cls_name]
 
 
+_codecs_by_type = dict()
+_codecs_by_tag  = dict()
+
+def register_codec(typ, tag, encode, decode):
+    '''Write values of the python type typ as elements with a type
+    attribute of tag, whose text is encode(value). Elements with that
+    tag are read back as decode(text). Registering a type or tag again
+    replaces the previous codec. A project can use this to handle types
+    that are not built in, or to replace a built in codec.'''
+    _codecs_by_type[typ] = (tag, encode)
+    _codecs_by_tag[tag] = decode
+    _model_plans.clear()
+    _model_plans_by_path.clear()
+
+
+# The python type that the value of each kind of field normally has. The
+# first match is used, so subclasses must come before their bases. The
+# plan for a model binds each field to the codec for its type; values of
+# any other type, such as None, are looked up when they are seen.
+_FIELD_TYPES = [
+    (models.BooleanField    , bool             )
+  , (models.NullBooleanField, bool             )
+  , (models.DateTimeField   , datetime.datetime)
+  , (models.DateField       , datetime.date    )
+  , (models.TimeField       , datetime.time    )
+  , (models.DecimalField    , decimal.Decimal  )
+  , (models.FloatField      , float            )
+  , (models.AutoField       , int              )
+  , (models.IntegerField    , int              )
+  , (models.CharField       , unicode          )
+  , (models.TextField       , unicode          )
+  , (models.BinaryField     , buffer           )
+  ]
+
+
+class _ModelPlan(object):
+    '''Everything that the per object serialization code needs to know
+    about a model class. It is worked out once per class (see
+    _model_plan) rather than for every object.
+
+    encoders is a list of (field name, fn) in field order, where fn is
+    called as fn(obj, name, value, context) and returns xml or None.
+    decoders maps (field name, type tag) to a function which converts
+    the text of such an element back into a value.
+    columns is a list of (field name, type tag) in field order, as used
+    by the compact format. The tag of a ForeignKey is the path of the
+    class it refers to, and it is None if the type is not known.'''
+
+    def __init__(self, cls):
+        self.cls            = cls
+        self.name           = _path_to_class(cls)
+        self.to_xml         = hasattr(cls, 'to_xml')
+        self.from_xml       = hasattr(cls, 'from_xml')
+        self.xml_to_attribs = hasattr(cls, 'xml_to_attribs')
+        self.encoders       = list()
+        self.decoders       = dict()
+        self.columns        = list()
+        for field in cls._meta.fields:
+            if isinstance(field, models.ForeignKey):
+                self.encoders.append( (field.name, _field_to_xml) )
+                self.columns.append(
+                        (field.name, _path_to_class(field.rel.to)) )
+                continue
+            for field_cls,typ in _FIELD_TYPES:
+                if isinstance(field, field_cls) and typ in _codecs_by_type:
+                    tag, encode = _codecs_by_type[typ]
+                    self.encoders.append(
+                        (field.name, _typed_encoder(typ, tag, encode)) )
+                    self.decoders[(field.name, tag)] = _codecs_by_tag[tag]
+                    self.columns.append( (field.name, tag) )
+                    break
+            else:
+                self.encoders.append( (field.name, _field_to_xml) )
+                self.columns.append( (field.name, None) )
+
+
+def _typed_encoder(typ, tag, encode):
+    def encoder(obj, k, v, context):
+        if type(v) is typ:
+            return _etn(k, text=encode(v), type=tag)
+        return _field_to_xml(obj, k, v, context)
+    return encoder
+
+
+_model_plans = dict()
+_model_plans_by_path = dict()
+
+
+def _text(s):
+    return s or ''      # Empty elements have None for their text.
+
+register_codec(type(None)       , 'none'    , lambda v: None
+                                            , lambda s: None)
+register_codec(bool             , 'bool'    , lambda v: 'True' if v else 'False'
+                                            , _str_to_bool)
+register_codec(int              , 'int'     , str, int)
+register_codec(long             , 'long'    , str, long)
+# str would round to 12 significant digits; repr round trips.
+register_codec(float            , 'float'   , repr, float)
+register_codec(decimal.Decimal  , 'decimal' , str, decimal.Decimal)
+register_codec(str              , 'str'     , _text, lambda s: str(_text(s)))
+register_codec(unicode          , 'unicode' , _text
+                                            , lambda s: unicode(_text(s)))
+register_codec(datetime.datetime, 'datetime', _datetime_to_str
+                                            , _str_to_datetime)
+register_codec(datetime.date    , 'date'    , str, _str_to_date)
+register_codec(datetime.time    , 'time'    , lambda v: v.isoformat()
+                                            , _str_to_time)
+register_codec(buffer           , 'buffer'  , base64.b64encode
+                                            , base64.b64decode)
+register_codec(uuid.UUID        , 'uuid'    , str, uuid.UUID)
+register_codec(dict             , 'json'    , json.dumps, json.loads)
+register_codec(list             , 'json'    , json.dumps, json.loads)
+
+def _model_plan(cls):
+    plan = _model_plans.get(cls)
+    if plan is None:
+        plan = _model_plans[cls] = _ModelPlan(cls)
+    return plan
+
+
+def _model_plan_for_path(class_pathname):
+    plan = _model_plans_by_path.get(class_pathname)
+    if plan is None:
+        plan = _model_plan(_get_class_from_class_pathname(class_pathname))
+        _model_plans_by_path[class_pathname] = plan
+    return plan
+
+
+_owned_models_cache = dict()
+
 def owned_models(cls, delegate=True):
     '''Return a list of all model classes that have a ForeignKey
     referencing this class. They should not be owned by any other
@@ -115,40 +294,934 @@ def owned_models(cls, delegate=True):
     returns all the models which refer to the model passed in.
     For example, a User might own a Yard:
     (Yard       , lambda self,o: o.get(user__exact=self.id()))
+
+    The result is worked out once per class, including the result of
+    a class's own owned_models, and must not be modified. See
+    clear_caches.
     '''
-    if delegate and hasattr(cls, 'owned_models'):
-        return cls.owned_models()
+    key = (cls, delegate)
+    ret = _owned_models_cache.get(key)
+    if ret is None:
+        if delegate and hasattr(cls, 'owned_models'):
+            ret = cls.owned_models()
+        else:
+            ret = _discover_owned_models(cls)
+        _owned_models_cache[key] = ret
+    return ret
 
+
+def _discover_owned_models(cls):
     ret = []
-    for name in dir(cls):
-        if name.endswith('_set'):
-            field = getattr(cls, name)
-            if field.__class__.__name__=='ReverseManyRelatedObjectsDescriptor':
-                raise Exception('implement this')
-            elif field.__class__.__name__=='RelatedManager':
-                child_cls = field.model
-            elif field.__class__.__name__=='ForeignRelatedObjectsDescriptor':
-                child_cls = field.related.model
-            elif field.__class__.__name__=='ManyRelatedObjectsDescriptor':
-                child_cls = field.related.model
-            else:
-                assert False, 'Do not know how to handle %r.%s %r' % (
-                                cls,name,field)
-            def f(self, name=name, cls=cls, child_cls=child_cls):
-                # I'm not proud of this.
-                set_attr = getattr(self,name)
-                core_filters = set_attr.core_filters
-                assert len(core_filters)==1, '%r %s: %r' % (
-                                self, name, core_filters )
-                children = list( child_cls.objects.filter(
-                                    **{core_filters.keys()[0]:self.pk
-                                      }) )
-                return children
-            ret.append( (child_cls, f) )
+    for related in cls._meta.get_all_related_objects():
+        if related.field.rel.parent_link:
+            continue    # Model inheritance, not ownership.
+        ret.append( (related.model, _owned_members_fn(related.model
+                                                     , related.field)) )
+    for related in cls._meta.get_all_related_many_to_many_objects():
+        ret.append( (related.model, _owned_m2m_members_fn(related)) )
     return ret
 
 
-def models_to_xml(models_to_serialize, include_rest_of_app=True):
+def _owned_members_fn(child_cls, fk):
+    target = fk.rel.get_related_field()
+    def f(self):
+        return list( child_cls.objects.filter(
+                            **{fk.attname:getattr(self, target.attname)}) )
+    f.fk = fk
+    f.batch = _owned_batch_fn(child_cls, fk)
+    return f
+
+
+def _owned_m2m_members_fn(related):
+    name = related.get_accessor_name()
+    def f(self):
+        return list( getattr(self, name).all() )
+    return f
+
+
+def clear_caches():
+    '''Forget what has been worked out about the model classes, such
+    as their owned models. This is only needed if the classes change
+    after they have been serialized, which normally only happens in
+    tests.'''
+    _owned_models_cache.clear()
+    _model_plans.clear()
+    _model_plans_by_path.clear()
+
+
+def _owned_batch_fn(child_cls, fk):
+    '''Return a function which does the same job as an owned_models
+    member function for a whole list of parents at once. It returns a
+    dict of parent pk to the list of children of that parent. The
+    children have their other ForeignKeys loaded by the same query.'''
+    target = fk.rel.get_related_field()
+    others = _foreign_key_names(child_cls, exclude=fk)
+    def batch(parents):
+        ret = dict()
+        for chunk in _chunks(parents, _PREFETCH_BATCH_SIZE):
+            by_key = dict( (getattr(p, target.attname), p) for p in chunk )
+            qs = child_cls.objects.filter(
+                            **{'%s__in' % fk.attname: list(by_key)})
+            for child in qs.select_related(*others):
+                parent = by_key[getattr(child, fk.attname)]
+                # Saves a query if the child refers to its parent.
+                setattr(child, fk.get_cache_name(), parent)
+                ret.setdefault(parent.pk, []).append(child)
+        return ret
+    return batch
+
+
+def _foreign_key_names(cls, exclude=None):
+    return [ f.name for f in cls._meta.fields
+             if isinstance(f, models.ForeignKey) and f is not exclude ]
+
+
+def _chunks(iterable, size):
+    '''Yield lists of up to size items from iterable.'''
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class SerializationStats(object):
+    '''Records what an export or import spent its time on, per model
+    class. Pass one as the stats argument of models_to_xml,
+    xml_to_models or their streaming versions, and call report()
+    afterwards. The same object may be passed to several calls, which
+    adds up their figures.
+
+    Time is charged to the class whose objects were being worked on,
+    not including time spent on the objects nested in them. Queries are
+    counted with a QueryCounter while stats are being collected.'''
+
+    _FIGURES = ( 'rows', 'seconds', 'field_seconds', 'queries'
+               , 'query_seconds', 'fixups' )
+
+    def __init__(self):
+        self.by_class = dict()
+        self._stack = [ (None, None) ]
+        self._time = None
+        self._counter = QueryCounter()
+        self._queries = 0
+        self._query_seconds = 0.0
+
+    def report(self):
+        '''Return a list with a dict of figures for each model class,
+        the class that took longest first. seconds includes
+        field_seconds, the time spent encoding or decoding field values,
+        and query_seconds, the time the db took. fixups is the number of
+        references which were loaded before the object they refer to.'''
+        ret = list()
+        for cls,figures in self.by_class.items():
+            figures = dict(figures, model=_path_to_class(cls))
+            figures['seconds'] += figures['field_seconds']
+            ret.append(figures)
+        ret.sort(key=lambda figures: -figures['seconds'])
+        return ret
+
+    def count(self, cls, figure, n=1):
+        self._figures(cls)[figure] += n
+
+    @contextlib.contextmanager
+    def collecting(self):
+        with self._counter:
+            self._time = time.time()
+            self._queries = self._counter.queries
+            self._query_seconds = self._counter.seconds
+            try:
+                yield
+            finally:
+                self._switch()
+
+    @contextlib.contextmanager
+    def charging(self, cls, figure='seconds'):
+        '''Charge the time and queries of the block to cls, under
+        figure, until another block is entered.'''
+        self._switch()
+        self._stack.append( (cls, figure) )
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    def _switch(self):
+        now = time.time()
+        cls, figure = self._stack[-1]
+        if cls is not None:
+            figures = self._figures(cls)
+            figures[figure] += now - self._time
+            figures['queries'] += self._counter.queries - self._queries
+            figures['query_seconds'] += ( self._counter.seconds
+                                        - self._query_seconds )
+        self._time = now
+        self._queries = self._counter.queries
+        self._query_seconds = self._counter.seconds
+
+    def _figures(self, cls):
+        figures = self.by_class.get(cls)
+        if figures is None:
+            figures = self.by_class[cls] = dict.fromkeys(self._FIGURES, 0)
+        return figures
+
+
+class QueryCounter(object):
+    '''Counts the queries made on the default connection inside a with
+    block, and the seconds they took, in its queries and seconds. Unlike
+    CaptureQueriesContext the queries are not kept, so it does not use
+    more memory the more queries are made. The counts add up over
+    several blocks.'''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self._old = list()
+
+    def __enter__(self):
+        db = connections[DEFAULT_DB_ALIAS]
+        self._old.append( db.__dict__.get('cursor') )
+        cursor = db.cursor
+        db.cursor = lambda: _CountingCursor(cursor(), self)
+        return self
+
+    def __exit__(self, *exc_info):
+        db = connections[DEFAULT_DB_ALIAS]
+        old = self._old.pop()
+        if old is None:
+            del db.cursor
+        else:
+            db.cursor = old
+        return False
+
+    def query_done(self, seconds):
+        self.queries += 1
+        self.seconds += seconds
+
+
+class _CountingCursor(object):
+    '''Wraps a cursor, telling a QueryCounter how long each query took.'''
+
+    def __init__(self, cursor, counter):
+        self.cursor  = cursor
+        self.counter = counter
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.cursor.__exit__(*exc_info)
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.counter.query_done(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.counter.query_done(time.time() - start)
+
+
+class _NotCharging(object):
+    def __enter__(self):
+        pass
+    def __exit__(self, *exc_info):
+        return False
+
+_NOT_CHARGING = _NotCharging()
+
+def _charging(context, cls, figure='seconds'):
+    stats = context.get('stats')
+    if stats is None:
+        return _NOT_CHARGING
+    return stats.charging(cls, figure)
+
+
+def _count(context, cls, figure, n=1):
+    stats = context.get('stats')
+    if stats is not None:
+        stats.count(cls, figure, n)
+
+
+def _collecting(stats):
+    if stats is None:
+        return _NOT_CHARGING
+    return stats.collecting()
+
+
+# Rows of a class between calls to an on_progress callback.
+_PROGRESS_EVERY = 1000
+
+
+class SerializationCancelled(Exception):
+    '''Raised when an on_progress callback returns False.'''
+
+
+class _Progress(object):
+    '''Calls on_progress(model class, rows done, total rows) for every
+    every rows of a class, and once more for each class at the end. The
+    total is None if it is not known. If on_progress returns False the
+    work is stopped by raising SerializationCancelled.'''
+
+    def __init__(self, on_progress, every, totals):
+        self.on_progress = on_progress
+        self.every       = every
+        self.totals      = totals
+        self.done        = collections.OrderedDict()
+
+    def row_done(self, cls):
+        done = self.done[cls] = self.done.get(cls, 0) + 1
+        if done % self.every == 0:
+            self._report(cls)
+
+    def finish(self):
+        for cls,done in self.done.items():
+            if done % self.every:
+                self._report(cls)
+
+    def _report(self, cls):
+        if self.on_progress(cls, self.done[cls],
+                            self.totals.get(cls)) is False:
+            raise SerializationCancelled(
+                    'Cancelled after {} {} rows.'.format(
+                        self.done[cls], _path_to_class(cls)))
+
+
+def _new_progress(on_progress, every, totals_fn):
+    if on_progress is None:
+        return None
+    return _Progress(on_progress, every, totals_fn())
+
+
+def _row_done(context, cls):
+    _count(context, cls, 'rows')
+    progress = context.get('progress')
+    if progress is not None:
+        progress.row_done(cls)
+
+
+def _finish_progress(context):
+    if context['progress'] is not None:
+        context['progress'].finish()
+
+
+def _export_totals(models_to_serialize, include_rest_of_app):
+    '''Count the rows of the classes that will be exported, which are
+    the top level classes and the classes they own.'''
+    totals = dict()
+    todo = _models_to_export(models_to_serialize, include_rest_of_app)
+    while todo:
+        cls = todo.pop()
+        if cls not in totals:
+            totals[cls] = cls.objects.count()
+            todo.extend( child_cls for child_cls,fn in owned_models(cls) )
+    return totals
+
+
+def models_to_xml(models_to_serialize, include_rest_of_app=True,
+                  compact=False, stats=None, on_progress=None,
+                  progress_every=_PROGRESS_EVERY):
+    '''If compact is True the objects are written in the compact format
+    (see _compact_xml) instead, which xml_to_models also reads. Any
+    postprocess steps are then passed the compact xml.
+    stats may be a SerializationStats, which is told what was done.
+    on_progress, if given, is called as on_progress(model class, rows
+    done, total rows) after every progress_every rows of a class, and
+    for each class at the end. The totals are counted beforehand. If it
+    returns False the export stops with SerializationCancelled.'''
+    xml = ET.Element('ModelData')
+    progress = _new_progress(on_progress, progress_every,
+                             lambda: _export_totals(models_to_serialize,
+                                                    include_rest_of_app))
+    context = _new_export_context(models_to_serialize, stats, progress)
+    nodes = _iter_models_to_xml(models_to_serialize, context,
+                                include_rest_of_app)
+    if compact:
+        xml.set('format', 'compact')
+        nodes = _iter_compact_xml(nodes)
+    with _collecting(stats):
+        for node in nodes:
+            xml.append(node)
+        while context['postprocess']:
+            x = context['postprocess'].pop(0)
+            x(xml, context)
+    _finish_progress(context)
+    return  xml
+
+
+def models_to_xml_stream(models_to_serialize, fileobj,
+                         include_rest_of_app=True, compact=False, stats=None,
+                         on_progress=None, progress_every=_PROGRESS_EVERY):
+    '''Like models_to_xml, but each top level object is written to
+    fileobj as soon as it has been serialized instead of being collected
+    under one ModelData element. Only one top level subtree is held in
+    memory at a time. If the export is cancelled, what has been written
+    so far is not valid xml.'''
+    for text in models_to_xml_chunks(models_to_serialize, include_rest_of_app,
+                                     compact, stats, on_progress,
+                                     progress_every):
+        fileobj.write(text)
+
+
+def models_to_xml_chunks(models_to_serialize, include_rest_of_app=True,
+                         compact=False, stats=None, on_progress=None,
+                         progress_every=_PROGRESS_EVERY):
+    '''Like models_to_xml_stream, but yield the xml text a top level
+    object at a time instead of writing it to a file. The work is done
+    as the text is asked for, which suits a StreamingHttpResponse.'''
+    progress = _new_progress(on_progress, progress_every,
+                             lambda: _export_totals(models_to_serialize,
+                                                    include_rest_of_app))
+    context = _new_export_context(models_to_serialize, stats, progress)
+    nodes = _iter_models_to_xml(models_to_serialize, context,
+                                include_rest_of_app)
+    if compact:
+        yield '<ModelData format="compact">'
+        nodes = _iter_compact_xml(nodes)
+    else:
+        yield '<ModelData>'
+    with _collecting(stats):
+        for node in nodes:
+            yield xml_to_string(node)
+    yield '</ModelData>'
+    _finish_progress(context)
+    if context['postprocess']:
+        # These are passed the whole document, which no longer exists.
+        raise Exception('Postprocess steps are not supported when'
+                        ' streaming: {!r}'.format(context['postprocess']))
+
+
+def models_to_xml_parallel(models_to_serialize, fileobj, processes=None,
+                           chunks=1, include_rest_of_app=True):
+    '''Like models_to_xml_stream, but the work is split up and done by
+    a pool of processes, each with its own db connection. Each top level
+    class, together with the classes it owns, is a separate job. If
+    chunks is more than 1 the top level class's rows are also split into
+    that many ranges of (integer) primary keys.
+
+    Objects are nested under the same owners as with models_to_xml, and
+    each is written once. As a job cannot know what other jobs have
+    written, objects referred to by a ForeignKey are always written as
+    references rather than in place, so the xml may contain references
+    to objects which appear later. A class which is referred to but not
+    exported (from another app, say) is exported as well, all of it,
+    so that the references can be loaded.
+
+    processes is passed to multiprocessing.Pool. If it is 0 the jobs are
+    run one after the other in this process instead. Otherwise the db
+    connections are closed before the workers start, so this must not be
+    called inside a transaction, and the workers only see committed
+    rows.'''
+    if processes != 0:
+        assert not any( conn.in_atomic_block for conn in connections.all() ), \
+                'models_to_xml_parallel closes the db connections, which' \
+                ' would lose the transaction that it was called in.'
+    jobs = _export_jobs(models_to_serialize, include_rest_of_app, chunks)
+    fileobj.write('<ModelData>')
+    if processes == 0:
+        for fragment in itertools.imap(_export_job, jobs):
+            fileobj.write(fragment)
+    else:
+        # The workers must open their own connections rather than share
+        # the one that is open now.
+        for conn in connections.all():
+            conn.close()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        try:
+            for fragment in pool.imap(_export_job, jobs):
+                fileobj.write(fragment)
+        finally:
+            pool.close()
+            pool.join()
+    fileobj.write('</ModelData>')
+
+
+def _init_worker():
+    if not django.apps.apps.ready:
+        django.setup()
+
+
+def _export_jobs(models_to_serialize, include_rest_of_app, chunks):
+    '''Return the jobs for models_to_xml_parallel, in output order. Each
+    is a tuple of (kind, classes, owned_by, pk range), using class path
+    names so that it can be pickled. classes is a top level class and
+    the classes it owns, and owned_by is the same for every job. kind is
+    "all" to write everything in classes, "range" for only the top level
+    objects in the pk range (and what they own), or "rest" for objects
+    of the owned classes which have no owner.'''
+    owned_by = dict([(cls,None) for cls in models_to_serialize])
+    groups = list()
+    for cls in _models_to_export(models_to_serialize, include_rest_of_app):
+        if owned_by.get(cls) is None:
+            owned_by[cls] = None
+            group = [cls]
+            _claim_owned_models(cls, owned_by, group)
+            groups.append(group)
+
+    # The jobs write ForeignKeys as references, so a class which is only
+    # referred to, and is not exported, needs a job of its own. Classes
+    # are started before those they own, so that these end up nested
+    # as they would with models_to_xml.
+    in_tree = list()
+    for group in groups:
+        for cls in group:
+            all_models_in_tree(cls, in_tree)
+    missing = [ cls for cls in in_tree if cls not in owned_by ]
+    owned = set( child_cls for cls in missing
+                 for child_cls,membersFn in owned_models(cls)
+                 if child_cls is not cls )
+    for cls in [ x for x in missing if x not in owned ] + missing:
+        if cls not in owned_by:
+            owned_by[cls] = None
+            group = [cls]
+            _claim_owned_models(cls, owned_by, group)
+            groups.append(group)
+
+    owned_by_paths = [ (_path_to_class(cls), owner and _path_to_class(owner))
+                       for cls,owner in owned_by.items() ]
+    jobs = list()
+    for group in groups:
+        paths = [ _path_to_class(cls) for cls in group ]
+        ranges = None
+        if chunks > 1 and _ownership_fks(group, owned_by):
+            ranges = _pk_ranges(group[0], chunks)
+        if ranges:
+            for pk_range in ranges:
+                jobs.append( ('range', paths, owned_by_paths, pk_range) )
+            jobs.append( ('rest', paths, owned_by_paths, None) )
+        else:
+            jobs.append( ('all', paths, owned_by_paths, None) )
+    return jobs
+
+
+def _claim_owned_models(cls, owned_by, group):
+    '''Give cls the owned classes that nothing owns yet, and so on down,
+    in the same order as _model_to_xml would claim them.'''
+    for child_cls,membersFn in owned_models(cls):
+        if child_cls not in owned_by:
+            owned_by[child_cls] = cls
+            group.append(child_cls)
+            _claim_owned_models(child_cls, owned_by, group)
+
+
+def _ownership_fks(group, owned_by):
+    '''Return a dict of each owned class in group to the ForeignKey that
+    refers to its owner, or None if that isn't known for all of them.'''
+    ret = dict()
+    for cls in group[1:]:
+        for child_cls,membersFn in owned_models(owned_by[cls]):
+            if child_cls is cls and hasattr(membersFn, 'fk'):
+                ret[cls] = membersFn.fk
+                break
+        else:
+            return None
+    return ret
+
+
+def _pk_ranges(cls, chunks):
+    bounds = cls.objects.aggregate(lo=models.Min('pk'), hi=models.Max('pk'))
+    if bounds['lo'] is None:
+        return None
+    step = (bounds['hi'] - bounds['lo']) // chunks + 1
+    return [ (lo, lo+step-1)
+             for lo in range(bounds['lo'], bounds['hi']+1, step) ]
+
+
+def _export_job(job):
+    '''Run one of the jobs from _export_jobs, returning its xml.'''
+    kind, paths, owned_by_paths, pk_range = job
+    group = [ _model_plan_for_path(path).cls for path in paths ]
+    context = _new_export_context([])
+    for path,owner_path in owned_by_paths:
+        context['owned_by'][_model_plan_for_path(path).cls] = \
+                owner_path and _model_plan_for_path(owner_path).cls
+    context['inline'] = False
+
+    querysets = list()
+    if kind in ('all', 'range'):
+        qs = group[0].objects.all()
+        if pk_range:
+            qs = qs.filter(pk__gte=pk_range[0], pk__lte=pk_range[1])
+        querysets.append(qs)
+    if kind == 'all':
+        querysets.extend( cls.objects.all() for cls in group[1:] )
+    elif kind == 'rest':
+        # The rows with an owner have been written by the range jobs.
+        fks = _ownership_fks(group, context['owned_by'])
+        querysets.extend( cls.objects.filter(
+                                **{'%s__isnull' % fks[cls].attname:True})
+                          for cls in group[1:] )
+
+    xml = list()
+    for qs in querysets:
+        for node in _iter_class_to_xml(qs, context):
+            xml.append(xml_to_string(node))
+    if context['postprocess']:
+        raise Exception('Postprocess steps are not supported when'
+                        ' exporting in parallel: {!r}'.format(
+                                context['postprocess']))
+    return ''.join(xml)
+
+
+def models_to_xml_delta(models_to_serialize, manifest=None,
+                        timestamp_fields=None, include_rest_of_app=True):
+    '''Return (xml, manifest), where xml only has the objects which
+    were added or changed since the export that returned manifest, and
+    a ___deleted element for each object which has gone since. The
+    returned manifest is passed to the next call. If manifest is None
+    every object is included.
+
+    Each object is written at the top level, with ForeignKeys as
+    references, rather than nested under its owner. Changes are found
+    by comparing a checksum of each row with the one in the manifest.
+    timestamp_fields may map classes to the name of a field which is
+    updated when a row changes, such as a DateTimeField with auto_now.
+    Then only rows whose timestamp has moved on, or with a higher pk
+    than before, are checked.
+
+    The manifest is a dict of class path name to a dict holding
+    max_pk, max_timestamp and checksums (pk to checksum). It only holds
+    strings and numbers, so it can be kept as JSON between calls.'''
+    manifest = manifest or dict()
+    timestamp_fields = timestamp_fields or dict()
+    models = _models_to_export(models_to_serialize, include_rest_of_app)
+    xml = ET.Element('ModelData')
+    context = _new_export_context(models)
+    context['inline'] = False
+    new_manifest = dict()
+    for cls in models:
+        path = _path_to_class(cls)
+        changed, deleted, new_manifest[path] = _changed_rows(
+                cls, manifest.get(path), timestamp_fields.get(cls))
+        for chunk in _chunks(sorted(changed), _PREFETCH_BATCH_SIZE):
+            for node in _iter_class_to_xml(cls.objects.filter(pk__in=chunk)
+                                                      .order_by('pk')
+                                          , context):
+                xml.append(node)
+        for pk in sorted(deleted):
+            xml.append( _etn('___deleted', to_type=path, text=unicode(pk)) )
+    return xml, new_manifest
+
+
+def _changed_rows(cls, previous, timestamp_field):
+    '''Return the pks of the rows of cls which are new or have changed
+    since previous (a manifest entry, or None), the pks which have been
+    deleted, and the new manifest entry.
+
+    The entry only holds strings and numbers, so that it can be stored
+    as JSON: the checksums are keyed by the pk as a string, and max_pk
+    and max_timestamp are turned back into field values when read.'''
+    previous = previous or dict(max_pk=None, max_timestamp=None,
+                                checksums=dict())
+    pk_field = cls._meta.pk
+    checksums = dict( (unicode(k), v)
+                      for k,v in previous['checksums'].items() )
+    qs = cls.objects.order_by('pk')
+    if timestamp_field and previous['max_timestamp'] is not None:
+        max_timestamp = cls._meta.get_field(timestamp_field).to_python(
+                                                previous['max_timestamp'])
+        pks = list(qs.values_list('pk', flat=True))
+        current = set( unicode(pk) for pk in pks )
+        current_max_pk = max(pks) if pks else previous['max_pk']
+        # Rows changed since the last export may have the same timestamp
+        # as it, so those are checked again. Their checksums leave out
+        # the ones which have not changed.
+        q = models.Q(**{timestamp_field+'__gte': max_timestamp})
+        if previous['max_pk'] is not None:
+            q |= models.Q(pk__gt=pk_field.to_python(previous['max_pk']))
+        qs = qs.filter(q)
+    else:
+        current = None
+
+    changed = list()
+    attnames = [ f.attname for f in cls._meta.fields ]
+    pk_index = attnames.index(pk_field.attname)
+    seen = set()
+    for row in qs.values_list(*attnames).iterator():
+        pk = row[pk_index]
+        key = unicode(pk)
+        seen.add(key)
+        checksum = hashlib.md5(repr(row)).hexdigest()
+        if checksums.get(key) != checksum:
+            checksums[key] = checksum
+            changed.append(pk)
+    if current is None:
+        current = seen
+        current_max_pk = pk if seen else previous['max_pk']
+    deleted = set(checksums) - current
+    for key in deleted:
+        del checksums[key]
+
+    entry = dict(checksums=checksums,
+                 max_timestamp=previous['max_timestamp'],
+                 max_pk=_manifest_value(current_max_pk))
+    if timestamp_field:
+        entry['max_timestamp'] = _manifest_value(cls.objects.aggregate(
+                        ts=models.Max(timestamp_field))['ts'])
+    return changed, [ pk_field.to_python(key) for key in deleted ], entry
+
+
+def _manifest_value(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
+
+def models_to_xml_subgraph(roots, compact=False, stats=None):
+    '''Return the xml of just the root objects, the objects they own
+    (and those own in turn), and the objects any of those refer to
+    through ForeignKeys, and so on. roots is a list of querysets, or of
+    (model class, list of pks). The objects are nested as by
+    models_to_xml, with the roots at the top level. compact and stats
+    are as for models_to_xml.
+
+    Objects which are only referred to do not bring the objects they own
+    with them. For example the Orders of one customer bring their
+    OrderEntry rows, and the MenuItems and Menus those refer to, but not
+    the other MenuItems of those Menus.
+
+    The objects are found a step out from the roots at a time, with a
+    query per class and relation for all the objects found by the
+    previous step (see _subgraph). So the time taken depends on the size
+    of the subgraph rather than of the db.'''
+    root_objs, loaded = _subgraph(roots)
+    root_classes = list()
+    for obj in root_objs:
+        if obj.__class__ not in root_classes:
+            root_classes.append(obj.__class__)
+    context = _new_export_context(root_classes, stats)
+    _prefetch_subgraph(loaded, context)
+    xml = ET.Element('ModelData')
+    # Anything not reached from the roots, such as the owner of an
+    # object with a custom owned_models, is written at the top level.
+    objs = itertools.chain( root_objs
+                          , *[ objs.values() for objs in loaded.values() ])
+    nodes = ( _model_to_xml(obj, context) for obj in objs
+              if obj not in context['touched'] )
+    if compact:
+        xml.set('format', 'compact')
+        nodes = _iter_compact_xml(nodes)
+    with _collecting(stats):
+        for node in nodes:
+            xml.append(node)
+    return xml
+
+
+def _subgraph(roots):
+    '''Load the objects for models_to_xml_subgraph. Return a list of
+    the root objects, and an OrderedDict of class to an OrderedDict of
+    pk to object, holding every object in the subgraph. ForeignKeys
+    between the objects are set to refer to these same objects, so that
+    following them needs no more queries.'''
+    loaded = collections.OrderedDict()
+    owners = set()      # (class, pk) of objects whose owned objects count.
+    find_owned = collections.OrderedDict()
+    find_targets = collections.OrderedDict()
+
+    def add(obj, owned):
+        objs = loaded.setdefault(obj.__class__, collections.OrderedDict())
+        if obj.pk not in objs:
+            objs[obj.pk] = obj
+            find_targets.setdefault(obj.__class__, list()).append(obj)
+        obj = objs[obj.pk]
+        if owned and (obj.__class__, obj.pk) not in owners:
+            owners.add( (obj.__class__, obj.pk) )
+            find_owned.setdefault(obj.__class__, list()).append(obj)
+        return obj
+
+    root_objs = list()
+    for root in roots:
+        if isinstance(root, tuple):
+            cls, pks = root
+            querysets = [ cls.objects.filter(pk__in=chunk)
+                          for chunk in _chunks(pks, _PREFETCH_BATCH_SIZE) ]
+        else:
+            querysets = [ root ]
+        for qs in querysets:
+            for obj in qs.select_related(*_foreign_key_names(qs.model)):
+                root_objs.append(add(obj, True))
+
+    while find_owned or find_targets:
+        todo, find_owned = find_owned, collections.OrderedDict()
+        for cls,objs in todo.items():
+            for child_cls,membersFn in owned_models(cls):
+                batchFn = getattr(membersFn, 'batch', None)
+                if batchFn is not None:
+                    children = batchFn(objs).values()
+                else:
+                    children = [ _owned_members(membersFn, obj)
+                                 for obj in objs ]
+                for child in itertools.chain(*children):
+                    add(child, True)
+        todo, find_targets = find_targets, collections.OrderedDict()
+        for cls,objs in todo.items():
+            for fk in cls._meta.fields:
+                if isinstance(fk, models.ForeignKey):
+                    for target in _fk_targets(fk, objs, loaded):
+                        add(target, False)
+
+    for cls,objs in loaded.items():
+        for fk in cls._meta.fields:
+            if not isinstance(fk, models.ForeignKey):
+                continue
+            target_field = fk.rel.get_related_field()
+            targets = dict( (getattr(t, target_field.attname), t) for t in
+                            loaded.get(fk.rel.to, dict()).values() )
+            for obj in objs.values():
+                target = targets.get(getattr(obj, fk.attname))
+                if target is not None:
+                    setattr(obj, fk.get_cache_name(), target)
+    return root_objs, loaded
+
+
+def _fk_targets(fk, objs, loaded):
+    '''Return the objects that fk refers to from objs, other than those
+    in loaded. Those which were fetched along with objs (by
+    select_related) are not fetched again.'''
+    ret = list()
+    target_field = fk.rel.get_related_field()
+    have = set( getattr(t, target_field.attname) for t in
+                loaded.get(fk.rel.to, dict()).values() )
+    missing = set()
+    for obj in objs:
+        value = getattr(obj, fk.attname)
+        if value is None or value in have:
+            continue
+        target = getattr(obj, fk.get_cache_name(), None)
+        if target is not None:
+            ret.append(target)
+            have.add(value)
+        else:
+            missing.add(value)
+    for chunk in _chunks(sorted(missing), _PREFETCH_BATCH_SIZE):
+        ret.extend( fk.rel.to.objects.filter(
+                            **{'%s__in' % target_field.name: chunk}) )
+    return ret
+
+
+def _prefetch_subgraph(loaded, context):
+    '''Fill in context['prefetched'] from the objects of a subgraph, so
+    that objects are only nested under their owners if they are in it,
+    and no queries are needed to find them.'''
+    for cls,objs in loaded.items():
+        for child_cls,membersFn in owned_models(cls):
+            fk = getattr(membersFn, 'fk', None)
+            if fk is None:
+                continue
+            target_field = fk.rel.get_related_field()
+            children = dict( (getattr(p, target_field.attname), list())
+                             for p in objs.values() )
+            for child in loaded.get(child_cls, dict()).values():
+                siblings = children.get(getattr(child, fk.attname))
+                if siblings is not None:
+                    siblings.append(child)
+            for p in objs.values():
+                context['prefetched'][(child_cls, cls, p.pk)] = \
+                        children[getattr(p, target_field.attname)]
+
+
+class _PkSet(object):
+    '''A set of primary keys. Small non-negative integers, which most
+    primary keys are, are kept in a bitmap as long as it stays smaller
+    than a set of them would be. Anything else is kept in a set.'''
+
+    # A set costs several hundred bits per member, so the bitmap may be
+    # grown to cover this many bits per member, or this many bits to
+    # begin with.
+    _BITS_PER_MEMBER = 256
+    _MIN_BITS        = 1 << 16
+
+    def __init__(self):
+        self.bits   = bytearray()
+        self.others = set()
+        self.count  = 0
+
+    def add(self, pk):
+        if pk in self:
+            return
+        self.count += 1
+        if type(pk) in (int, long) and pk >= 0:
+            if pk >> 3 >= len(self.bits):
+                needed = (pk >> 3) + 1
+                if 8*needed <= max(self._MIN_BITS,
+                                   self._BITS_PER_MEMBER * self.count):
+                    self.bits.extend( bytearray(
+                                max(needed, 2*len(self.bits)) -
+                                len(self.bits)) )
+            if pk >> 3 < len(self.bits):
+                self.bits[pk >> 3] |= 1 << (pk & 7)
+                return
+        self.others.add(pk)
+
+    def __contains__(self, pk):
+        if type(pk) in (int, long) and 0 <= pk >> 3 < len(self.bits) and \
+                self.bits[pk >> 3] & (1 << (pk & 7)):
+            return True
+        return bool(self.others) and pk in self.others
+
+    def __len__(self):
+        return self.count
+
+
+class _Touched(object):
+    '''The objects which have been serialized, as a _PkSet per class,
+    so that the objects themselves need not be kept. Supports add and
+    in, as a set of the objects would.'''
+
+    def __init__(self):
+        self.by_class = dict()
+
+    def add(self, obj):
+        cls = obj._meta.concrete_model
+        pks = self.by_class.get(cls)
+        if pks is None:
+            pks = self.by_class[cls] = _PkSet()
+        pks.add(obj.pk)
+
+    def __contains__(self, obj):
+        pks = self.by_class.get(obj._meta.concrete_model)
+        return pks is not None and obj.pk in pks
+
+    def __len__(self):
+        return sum( len(pks) for pks in self.by_class.values() )
+
+
+def _new_export_context(models_to_serialize, stats=None, progress=None):
+    return dict( postprocess = list()
+               # The objects which have been serialized (see _Touched).
+               , touched     = _Touched()
+               , owned_by    = dict([(cls,None)
+                                     for cls in models_to_serialize])
+               , prefetched  = dict()
+               # If False, objects referred to by a ForeignKey are always
+               # written as references, even if they have not been yet.
+               , inline      = True
+               , stats       = stats
+               , progress    = progress
+               )
+
+
+def _iter_models_to_xml(models_to_serialize, context, include_rest_of_app):
+    '''Yield the xml for each top level object in turn.'''
+    for cls in _models_to_export(models_to_serialize, include_rest_of_app):
+        for node in _iter_class_to_xml(cls.objects.all(), context):
+            yield node
+
+
+def _models_to_export(models_to_serialize, include_rest_of_app):
     # obj._meta.app_config.models lists all the app models!
     # Just specify root, and this will ensure everything else gets its
     # turn. Might only be for that app... auth is a different one.
@@ -156,120 +1229,324 @@ def models_to_xml(models_to_serialize, include_rest_of_app=True):
     if include_rest_of_app:
         # Add any additional models that are part of the app.
         for model in models_to_serialize:
+            # Keep the app's registration order, so the output is stable.
             newmodels = [ x for x in model._meta.app_config.models.values()
                           if x not in models ]
-            models += list(set( newmodels ))
-    xml = ET.Element('ModelData')
-    context = dict( postprocess = list()
-                  , touched     = set()
-                  , owned_by    = dict([(cls,None)
-                                        for cls in models_to_serialize])
-                  )
-    for cls in models:
-        for o in cls.objects.all():
+            models += newmodels
+    return models
+
+
+def _iter_class_to_xml(qs, context):
+    '''Yield the xml for each object in qs which has not already been
+    serialized.'''
+    # iterator() so that the whole table isn't cached in the queryset.
+    # The rows are handled in batches so that everything they own can
+    # be fetched with a few queries per batch rather than per row.
+    cls = qs.model
+    qs = qs.select_related(*_foreign_key_names(cls))
+    chunks = _chunks(qs.iterator(), _PREFETCH_BATCH_SIZE)
+    while True:
+        with _charging(context, cls):
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            _prefetch_owned(cls, chunk, context)
+        for o in chunk:
             if o not in context['touched']:
                 node = _model_to_xml(o, context)
                 if node is not None:
-                    xml.append(node)
-    while context['postprocess']:
-        x = x['postprocess'].pop(0)
-        x(xml, context)
-    return  xml
-
+                    yield node
+
+
+def _prefetch_owned(cls, parents, context):
+    '''Fetch the owned models of all the parents, and of those owned
+    models in turn, with one query per owned class. This is done a level
+    of ownership at a time, for all the objects at that level. The
+    results are left in context['prefetched'] for _model_to_xml to pick
+    up. Member functions without a batch equivalent are left alone, and
+    _model_to_xml will call them for each object as usual.'''
+    prefetched = context['prefetched']
+    level = [ (cls, parents) ]
+    while level:
+        next_level = list()
+        for cls,parents in level:
+            for child_cls,membersFn in owned_models(cls):
+                if context['owned_by'].get(child_cls, cls) is not cls:
+                    continue    # It will not be nested under these parents.
+                batchFn = getattr(membersFn, 'batch', None)
+                if batchFn is None:
+                    continue
+                todo = [ p for p in parents
+                         if p not in context['touched'] and
+                            (child_cls, cls, p.pk) not in prefetched ]
+                if not todo:
+                    continue
+                with _charging(context, child_cls):
+                    children = batchFn(todo)
+                for p in todo:
+                    prefetched[(child_cls, cls, p.pk)] = children.get(p.pk, [])
+                next_level.append( (child_cls,
+                        list(itertools.chain(*children.values()))) )
+        level = next_level
+
+
+# What _model_to_xml_steps yields: a request for the xml of a nested
+# object, or the xml of its own object.
+_NESTED = 'nested'
+_RESULT = 'result'
 
 def _model_to_xml(obj, context, delegate=True, name=None):  # obj is an instance
-    if obj in context['touched']:
+    '''Return the xml of obj, with the objects it owns nested in it, and
+    also the objects its ForeignKeys refer to unless they have been
+    serialized already. If obj has been serialized already, return a
+    reference to it if name is given, or else None.
+    The nested objects are handled with a stack of the objects in
+    progress rather than by recursion, so long chains of objects do not
+    run into the recursion limit.'''
+    stack = [ _model_to_xml_steps(obj, context, delegate, name) ]
+    value = None
+    while True:
+        kind, arg = stack[-1].send(value)
+        if kind is _NESTED:
+            stack.append( _model_to_xml_steps(arg[0], context, True, arg[1]) )
+            value = None
+        else:
+            stack.pop().close()
+            if not stack:
+                return arg
+            value = arg
+
+
+def _model_to_xml_steps(obj, context, delegate, name):
+    '''A generator which does the work of _model_to_xml for obj. For
+    each nested object it yields (_NESTED, (object, name)) and is sent
+    the xml of that object. Its last yield is (_RESULT, xml of obj).'''
+    if obj in context['touched'] or (name and not context.get('inline', True)):
         # Already saved or being saved. Return None or a reference.
         if not name:
-            return None # Nothing needed, it isn't a field.
-        return _etn( name, type='reference'
-                  , to_type=_path_to_class(obj.__class__)
-                  , text=repr(obj.pk))
+            yield _RESULT, None # Nothing needed, it isn't a field.
+        else:
+            yield _RESULT, _etn( name, type='reference'
+                               , to_type=_path_to_class(obj.__class__)
+                               , text=repr(obj.pk))
     context['touched'].add(obj)
-    if delegate and hasattr(obj, 'to_xml'):
-        return obj.to_xml(context, name)
-
-    # Default object serialization.
-    valnames = obj._default_manager.values()[0].keys()
-    valnames = [ k[:-3] if k.endswith('_id') else k for k in valnames ]
-
-    model_name = _path_to_class( obj.__class__ )
-    node = ET.Element(name, type=model_name) if name else ET.Element(model_name)
-    for name in valnames:
-        value = getattr(obj, name)
-        xml = _field_to_xml(obj, name, value, context)
-        if xml is not None:
-            node.append(xml)
-
-    owned = _etn('___owned')
-    for cls,membersFn in owned_models(obj):
-        if cls not in context['owned_by']:
-            context['owned_by'][cls] = obj.__class__
-        elif obj != context['owned_by'][cls]:
-            continue
-        # Example, (Yard, lambda o: o.get(user__exact=self.id())
-        try:
-            objs = membersFn(obj)
-        except Exception as e:
-            if e.__class__.__name__ != 'DoesNotExist':
-                raise
+    _row_done(context, obj.__class__)
+    plan = _model_plan(obj.__class__)
+    with _charging(context, obj.__class__):
+        if delegate and plan.to_xml:
+            yield _RESULT, obj.to_xml(context, name)
+
+        # Default object serialization.
+        node = ET.Element(name, type=plan.name) if name \
+                                                else ET.Element(plan.name)
+        stats = context.get('stats')
+        for name,encode in plan.encoders:
+            value = getattr(obj, name)
+            if encode is _field_to_xml and isinstance(value, models.Model):
+                xml = yield _NESTED, (value, name)
+            elif stats is None:
+                xml = encode(obj, name, value, context)
             else:
-                objs = []
-        for owned_obj in objs:
-            xml = _model_to_xml(owned_obj, context)
+                with stats.charging(obj.__class__, 'field_seconds'):
+                    xml = encode(obj, name, value, context)
             if xml is not None:
-                owned.append( xml )
-
-    if len(owned):
-        node.append(owned)
-
-    return node
+                node.append(xml)
+
+        owned = _etn('___owned')
+        for cls,membersFn in owned_models(obj.__class__):
+            if cls not in context['owned_by']:
+                context['owned_by'][cls] = obj.__class__
+            elif obj.__class__ != context['owned_by'][cls]:
+                continue
+            objs = context['prefetched'].pop((cls, obj.__class__, obj.pk),
+                                             None)
+            if objs is None:
+                with _charging(context, cls):
+                    objs = _owned_members(membersFn, obj)
+                _prefetch_owned(cls, objs, context)
+            for owned_obj in objs:
+                xml = yield _NESTED, (owned_obj, None)
+                if xml is not None:
+                    owned.append( xml )
+
+        if len(owned):
+            node.append(owned)
+
+    yield _RESULT, node
+
+
+def _owned_members(membersFn, obj):
+    # Example, (Yard, lambda o: o.get(user__exact=self.id())
+    try:
+        return list(membersFn(obj))
+    except Exception as e:
+        if e.__class__.__name__ != 'DoesNotExist':
+            raise
+        return []
 
 
 def _field_to_xml(obj, k, v, context):
-    if isinstance(v, models.Model):
+    codec = _codecs_by_type.get(type(v))
+    if codec is not None:
+        tag, encode = codec
+        return _etn(k, text=encode(v), type=tag)
+    elif isinstance(v, models.Model):
         return _model_to_xml(v, context, name=k)
-    elif type(v) == int:
-        return _etn(k, text=str(v), type=type(v).__name__)
-    elif type(v) in (str,unicode) :
-        return _etn(k, text=v, type=type(v).__name__)
-    elif type(v) == datetime.datetime:
-        return _etn( k, text=_datetime_to_str(v), type='datetime')
-    elif type(v) == datetime.date:
-        return _etn( k, text=str(v), type='date')
-    elif type(v) == float:
-        return _etn( k, text=str(v), type='float')
-    elif type(v) == buffer:
-        return _etn( k, text=base64.b64encode(v), type='buffer')
-    elif type(v) == bool:
-        return _etn(k, text='True' if v else 'False', type='bool')
     raise Exception('Unknown type: {0} {1}'.format(type(v), v))
 
 
+# The compact format. Rather than an element per field, each object is a
+# ___row element whose v attribute holds its field values, in the order
+# given by a ___columns element for its class. For example:
+#   <___columns id="3" type="xmldump.models.OrderEntry"
+#       >id:int,order:xmldump.models.Order,menuitem:xmldump.models.MenuItem,count:int</___columns>
+#   <___row c="3" v="1,1,1,2" />
+# An attribute is used rather than the text so that indenting the xml
+# does not change the values.
+# A ForeignKey column holds the pk of the object it refers to. Values are
+# separated by commas, and commas and backslashes in them are escaped with
+# a backslash. \N is None. \. means the field is given by a child of the
+# row instead: the ___row of an object written in place, with a field
+# attribute, or the usual element for a value that does not suit its
+# column. The other child ___rows are the owned objects. Objects of
+# classes with their own to_xml are written in the usual way; when they
+# are owned they are wrapped in an ___owned element, so that they are not
+# taken for fields.
+
+def _iter_compact_xml(nodes):
+    '''Yield the compact form of the top level xml in nodes. The
+    ___columns for a class come before the first row that uses them.'''
+    columns = dict()
+    for node in nodes:
+        headers = list()
+        row = _compact_xml(node, columns, headers)
+        for header in headers:
+            yield header
+        yield row
+
+
+def _compact_xml(node, columns, headers):
+    '''Return the compact form of node, the xml of an object. columns
+    maps class paths to the ids of their ___columns; those for classes
+    which have not been seen before are appended to headers.
+    The rows of nested objects are added to their parent's row when it
+    is made, and filled in afterwards from a stack, so that deep nesting
+    does not run into the recursion limit.'''
+    top = _compact_shell(node)
+    pending = [ (node, top) ]
+    while pending:
+        node, row = pending.pop()
+        if row is node:
+            continue    # Written by the class's own to_xml.
+        nested = list()
+        path = node.get('type', node.tag)
+        plan = _model_plan_for_path(path)
+        if path not in columns:
+            columns[path] = str(len(columns))
+            headers.append( _etn( '___columns', id=columns[path], type=path
+                                , text=','.join( '%s:%s' % (name, tag or '')
+                                                 for name,tag in plan.columns )) )
+        row.set('c', columns[path])
+        if node.tag != path:
+            row.set('field', node.tag)
+        by_name = dict( (elem.tag, elem) for elem in node )
+        values = list()
+        for name,tag in plan.columns:
+            elem = by_name.pop(name, None)
+            typ = None if elem is None else elem.get('type')
+            if elem is None:
+                values.append('\\.')
+            elif typ is not None and '.' in typ:
+                values.append('\\.')
+                child = _compact_shell(elem)
+                row.append(child)
+                nested.append( (elem, child) )
+            elif typ == tag or (typ == 'reference' and
+                                elem.get('to_type') == tag):
+                values.append(_escape_value(elem.text))
+            elif typ == 'none':
+                values.append('\\N')
+            else:
+                values.append('\\.')
+                row.append(elem)
+        row.set('v', ','.join(values))
+        for elem in node:
+            if elem.tag == '___owned':
+                for child_node in elem:
+                    child = _compact_shell(child_node)
+                    nested.append( (child_node, child) )
+                    if child.tag != '___row':
+                        wrapper = _etn('___owned')
+                        wrapper.append(child)
+                        child = wrapper
+                    row.append(child)
+            elif elem.tag in by_name:
+                row.append(elem)    # Not a field, such as __ entries.
+        pending.extend(reversed(nested))
+    return top
+
+
+def _compact_shell(node):
+    '''Return the element that the compact form of node will be made
+    in: an empty ___row, or node itself if its class has its own
+    to_xml.'''
+    if _model_plan_for_path(node.get('type', node.tag)).to_xml:
+        return node
+    return ET.Element('___row')
+
+
+def _escape_value(text):
+    return (text or '').replace('\\', '\\\\').replace(',', '\\,')
+
+
 @LoggingFilterContext.annotate(
         lambda rec: (not isinstance(rec.msg, basestring)) or
                     not (rec.msg.startswith('Deleting') or rec.msg=='Done.')
                     )
-def delete_all_models_in_db(root_models):
+def delete_all_models_in_db(root_models, fast=False, send_signals=True):
     '''Delete all object instances from the Django db. The top level
     classes must be passed in, but additional classes will be discovered
-    from them.
+    from them. Classes are emptied in reverse ForeignKey dependency
+    order (see model_dependency_levels), so rows are deleted before the
+    rows they refer to.
+    If fast is True each table is emptied with one DELETE statement,
+    rather than by Django's deletion collector, which loads every row to
+    find the rows that refer to it. Rows in other classes which refer to
+    the deleted ones are left alone rather than being deleted too. The
+    pre_delete and post_delete signals are still sent for classes which
+    have receivers for them, which means loading their rows, a batch at
+    a time, unless send_signals is False. send_signals can only be False
+    if fast is True.
     '''
-    objs = root_models[:]
-    i = 0
-    while i < len(objs) and i < 10:
-        new_objs = list()
-        all_models_in_tree(objs[i], new_objs)
-        for no in new_objs:
-            if no not in objs:
-                objs.append(no)
-        i += 1
-    for obj in objs:
-        logging.warn('Deleting %r...', obj)
-        obj.objects.all().delete()
+    assert fast or send_signals, 'Only fast deletes can skip the signals.'
+    for level in reversed(model_dependency_levels(root_models)):
+        for obj in level:
+            logging.warn('Deleting %r...', obj)
+            if not fast:
+                obj.objects.all().delete()
+            else:
+                _fast_delete(obj, send_signals)
     logging.warn('Done.')
 
 
+def _fast_delete(cls, send_signals):
+    qs = cls.objects.all()
+    if not send_signals or not ( models.signals.pre_delete.has_listeners(cls)
+                                 or models.signals.post_delete.has_listeners(cls)):
+        qs._raw_delete(qs.db)
+        return
+    for chunk in _chunks(qs.iterator(), _PREFETCH_BATCH_SIZE):
+        for obj in chunk:
+            models.signals.pre_delete.send(sender=cls, instance=obj,
+                                           using=qs.db)
+        cls.objects.filter(pk__in=[ obj.pk for obj in chunk ]) \
+                   ._raw_delete(qs.db)
+        for obj in chunk:
+            models.signals.post_delete.send(sender=cls, instance=obj,
+                                            using=qs.db)
+            setattr(obj, cls._meta.pk.attname, None)
+
+
 def all_models_in_tree(cls, accumulatingList, depth=20, delegate=True):
     '''Generate a list of model classes that are in the tree. This
     is so that they can all be cleared. The list is passed in.'''
@@ -292,11 +1569,13 @@ def all_models_in_tree(cls, accumulatingList, depth=20, delegate=True):
                              ,models.fields.TextField
                              ,models.fields.IntegerField
                              ,models.fields.FloatField
+                             ,models.fields.DecimalField
                              ,models.fields.DateField
                              ,models.fields.TimeField
                              ,models.fields.DateTimeField
                              ,models.fields.BinaryField
                              ,models.fields.BooleanField
+                             ,models.fields.NullBooleanField
                              )):
             pass
         elif isinstance(field, models.fields.related.ForeignKey):
@@ -309,23 +1588,653 @@ def all_models_in_tree(cls, accumulatingList, depth=20, delegate=True):
         all_models_in_tree(model, accumulatingList, depth-1)
 
 
-def xml_to_models(toplevel_xml):
+def model_dependency_levels(root_models):
+    '''Return all the model classes in the trees of root_models (see
+    all_models_in_tree), grouped into a list of levels. Classes only
+    have ForeignKeys to classes in earlier levels, apart from classes
+    in a ForeignKey cycle, which share a level.'''
+    classes = list()
+    for cls in root_models:
+        all_models_in_tree(cls, classes)
+    return _dependency_levels(classes)
+
+
+def _dependency_levels(classes):
+    deps = dict()
+    for cls in classes:
+        deps[cls] = set( f.rel.to for f in cls._meta.fields
+                         if isinstance(f, models.ForeignKey) and
+                            f.rel.to in classes and f.rel.to is not cls )
+    levels = list()
+    done = set()
+    remaining = list(classes)
+    while remaining:
+        level = [ cls for cls in remaining if deps[cls] <= done ]
+        if not level:
+            # A cycle. Whatever is left goes in together and the
+            # references between them are fixed up afterwards.
+            level = remaining
+        levels.append(level)
+        done.update(level)
+        remaining = [ cls for cls in remaining if cls not in done ]
+    return levels
+
+
+def xml_to_models(toplevel_xml, bulk=False, batch_size=_BULK_BATCH_SIZE,
+                  ordered=False, mode='create', delete_missing=False,
+                  stats=None, on_progress=None,
+                  progress_every=_PROGRESS_EVERY):
     '''Repopulate the Django db with instances as indicated by the
     xml that is provided.
+    If bulk is True the objects are not saved one at a time. They are
+    collected per class and inserted with bulk_create, batch_size rows
+    at a time, keeping the primary keys that are in the xml. Objects
+    without a primary key in the xml are still saved one at a time.
+    If ordered is True the objects are loaded a class at a time, with
+    the classes in ForeignKey dependency order (see
+    model_dependency_levels) instead of in document order. Each object
+    is then loaded after the objects it refers to.
+    mode is 'create' to add every object as a new row, or 'merge' to
+    match objects to existing rows by primary key. In merge mode rows
+    are only updated if they differ, and missing rows are inserted,
+    batch_size objects at a time as in bulk mode. If delete_missing is
+    also True, rows of the classes in the xml which are not in it are
+    deleted afterwards. delete_missing may instead be a list of root
+    models, as for models_to_xml, and then rows of every class in their
+    trees which are not in the xml are deleted, so the db ends up
+    holding just what the xml does.
+    ___deleted elements, as written by models_to_xml_delta, delete the
+    row they refer to in either mode.
+    The xml may also be in the compact format written by models_to_xml
+    with compact set.
+    stats and on_progress are as for models_to_xml, except that the
+    totals are counted from the xml. If the import is cancelled nothing
+    is changed.
     '''
     assert isinstance(toplevel_xml, ET.Element)
-    context = dict( postprocess  = list()
-                  , pp_needs_obj = list()
-                  )
+    progress = _new_progress(on_progress, progress_every,
+                             lambda: _import_totals(toplevel_xml))
+    context = _new_import_context(bulk, batch_size, mode, delete_missing,
+                                  stats, progress)
     assert toplevel_xml.tag == 'ModelData'
+    with _collecting(stats), transaction.atomic():
+        if ordered:
+            _xml_to_models_ordered(toplevel_xml, context)
+        else:
+            for obj_xml in toplevel_xml:
+                _load_top_level_xml(obj_xml, context)
+
+        _run_import_postprocess(context)
+        _finish_import(context)
+        _finish_progress(context)
+
+
+def _import_totals(toplevel_xml):
+    '''Count the objects of each class in the xml.'''
+    paths = collections.defaultdict(int)
+    columns = dict( (elem.get('id'), elem.get('type'))
+                    for elem in toplevel_xml if elem.tag == '___columns' )
+    for elem in _iter_elements(toplevel_xml):
+        if elem.tag == '___row':
+            paths[columns[elem.get('c')]] += 1
+        elif elem.tag == '___columns':
+            continue
+        elif '.' in elem.get('type', elem.tag):
+            paths[elem.get('type', elem.tag)] += 1
+    return dict( (_model_plan_for_path(path).cls, n)
+                 for path,n in paths.items() )
+
+
+def _load_top_level_xml(xml, context):
+    xml = _expand_top_level_xml(xml, context)
+    if xml is None:
+        pass
+    elif xml.tag == '___deleted':
+        _note_deleted(xml, context)
+    else:
+        xml_to_model(xml, context)
+
+
+def _collect_top_level_xml(toplevel_xml, by_class, context):
     for obj_xml in toplevel_xml:
-        xml_to_model(obj_xml, context)
+        obj_xml = _expand_top_level_xml(obj_xml, context)
+        if obj_xml is None:
+            pass
+        elif obj_xml.tag == '___deleted':
+            _note_deleted(obj_xml, context)
+        else:
+            _collect_model_xml(obj_xml, by_class)
 
+
+def _expand_top_level_xml(xml, context):
+    '''Return xml, or the usual form of it if it is a compact ___row.
+    ___columns are noted in the context, and None is returned.'''
+    if xml.tag == '___columns':
+        columns = xml.text.strip().split(',')
+        context['columns'][xml.get('id')] = (
+                xml.get('type'),
+                [ tuple(column.split(':', 1)) for column in columns ] )
+        return None
+    elif xml.tag == '___row':
+        return _expand_xml(xml, context['columns'])
+    return xml
+
+
+_VALUE_RE    = re.compile(r'(?:[^,\\]|\\.)*')
+_UNESCAPE_RE = re.compile(r'\\(.)')
+
+def _split_values(text):
+    '''Split the v attribute of a compact ___row into its escaped
+    values.'''
+    text = text or ''
+    values = list()
+    pos = 0
+    while True:
+        m = _VALUE_RE.match(text, pos)
+        values.append(m.group())
+        pos = m.end()
+        if pos == len(text):
+            return values
+        pos += 1    # Skip the comma.
+
+
+def _expand_xml(row, columns):
+    '''Return the usual form of a compact ___row (see _compact_xml).
+    As in _compact_xml, nested rows are expanded from a stack rather
+    than by recursion.'''
+    top = _expand_shell(row, columns)
+    pending = [ (row, top) ]
+    while pending:
+        row, node = pending.pop()
+        nested = list()
+        path, cols = columns[row.get('c')]
+        children = dict()
+        owned = _etn('___owned')
+        for elem in row:
+            if elem.tag == '___owned':
+                owned.extend(elem)
+            elif elem.tag != '___row':
+                children[elem.tag] = elem
+            elif elem.get('field'):
+                children[elem.get('field')] = elem
+            else:
+                child = _expand_shell(elem, columns)
+                owned.append(child)
+                nested.append( (elem, child) )
+        for (name,tag),value in zip(cols, _split_values(row.get('v'))):
+            if value == '\\.':
+                elem = children.pop(name, None)
+                if elem is not None and elem.tag == '___row':
+                    child = _expand_shell(elem, columns)
+                    nested.append( (elem, child) )
+                    elem = child
+            elif value == '\\N':
+                elem = _etn(name, type='none')
+            elif '.' in tag:
+                elem = _etn( name, type='reference', to_type=tag
+                           , text=_UNESCAPE_RE.sub(r'\1', value))
+            else:
+                elem = _etn(name, type=tag,
+                            text=_UNESCAPE_RE.sub(r'\1', value))
+            if elem is not None:
+                node.append(elem)
+        for elem in row:
+            if elem.tag not in ('___row', '___owned') and \
+                    elem.tag in children:
+                node.append(elem)   # Not a field, such as __ entries.
+        if len(owned):
+            node.append(owned)
+        pending.extend(reversed(nested))
+    return top
+
+
+def _expand_shell(row, columns):
+    '''Return the empty element that the usual form of row will be made
+    in.'''
+    path = columns[row.get('c')][0]
+    field = row.get('field')
+    return ET.Element(field, type=path) if field else ET.Element(path)
+
+
+def _note_deleted(xml, context):
+    cls = _model_plan_for_path(xml.get('to_type')).cls
+    context['deleted'][cls].add(cls._meta.pk.to_python(xml.text))
+
+
+def _xml_to_models_ordered(toplevel_xml, context):
+    by_class = collections.OrderedDict()
+    _collect_top_level_xml(toplevel_xml, by_class, context)
+    context['ordered'] = True
+    for level in _dependency_levels(list(by_class)):
+        for cls in level:
+            for xml in by_class.pop(cls):
+                xml_to_model(xml, context)
+            _run_import_postprocess(context)
+            if context['bulk'] is not None:
+                _flush_bulk(context)
+
+
+def xml_to_models_parallel(source, processes=None,
+                           batch_size=_BULK_BATCH_SIZE):
+    '''Like xml_to_models with bulk and ordered set, but the xml is
+    parsed and decoded by a pool of processes. source is the xml as a
+    string, or a file to read it from. It is cut into slices of
+    batch_size top level elements (see _top_level_slices), and each
+    worker parses a slice and returns the field values of the objects in
+    it. The rows are inserted by this process, a level of classes at a
+    time (see model_dependency_levels), so the whole load is still one
+    transaction and there is one index of primary keys. Classes with
+    their own from_xml or xml_to_attribs are loaded by this process as
+    usual.
+
+    processes is passed to multiprocessing.Pool, and defaults to the
+    number of CPUs. If it is 0, or there is only one CPU, the slices are
+    parsed by this process instead, which is about as fast as
+    xml_to_models.'''
+    text = source.read() if hasattr(source, 'read') else source
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    jobs = _import_jobs(text, batch_size)
+    del text
+    if processes is None and multiprocessing.cpu_count() < 2:
+        processes = 0
+
+    # The workers only parse and decode, so they never use the db
+    # connection.
+    by_class = collections.OrderedDict()
+    context = _new_import_context(True, batch_size)
+    context['ordered'] = True
+    pool = None
+    imap = itertools.imap
+    if processes != 0:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        imap = pool.imap
+    try:
+        for classes,deleted in imap(_import_job, jobs):
+            for path,decoded,rows in classes:
+                cls = _model_plan_for_path(path).cls
+                by_class.setdefault(cls, list()).append( (decoded, rows) )
+            for path,pks in deleted:
+                cls = _model_plan_for_path(path).cls
+                context['deleted'][cls].update(pks)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    with transaction.atomic():
+        for level in _dependency_levels(list(by_class)):
+            for cls in level:
+                for decoded,rows in by_class.pop(cls):
+                    for row in rows:
+                        if decoded:
+                            _add_decoded(cls, row[0], row[1], context)
+                        else:
+                            xml_to_model(ET.fromstring(row), context)
+            _run_import_postprocess(context)
+            _flush_bulk(context)
+        _finish_import(context)
+
+
+# Finds the tags, comments and so on in xml text. Only the closing tag
+# group, and whether the match ends with '/>', are needed to follow the
+# nesting. Quoted attribute values may hold '>'.
+_MARKUP_RE = re.compile( r'''<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[?!][^>]*>'''
+                         r'''|<(/?)[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>'''
+                       , re.S )
+
+def _top_level_slices(text):
+    '''Return the (start, end) offsets in text of each element directly
+    inside its root element, without parsing it.'''
+    slices = list()
+    depth = 0
+    for m in _MARKUP_RE.finditer(text):
+        closing = m.group(1)
+        if closing is None:
+            continue    # A comment, processing instruction or CDATA.
+        if closing:
+            depth -= 1
+            if depth == 1:
+                slices.append( (start, m.end()) )
+        elif text[m.end()-2] == '/':
+            if depth == 1:
+                slices.append( (m.start(), m.end()) )
+        else:
+            depth += 1
+            if depth == 2:
+                start = m.start()
+    return slices
+
+
+def _import_jobs(text, batch_size):
+    '''Return the jobs for xml_to_models_parallel: the text of a
+    ModelData element for each batch_size top level elements of text.
+    The ___columns of compact xml are put at the start of every job, as
+    rows may use them in any job after the one they appear in.'''
+    headers = list()
+    jobs = list()
+    for chunk in _chunks(_top_level_slices(text), batch_size):
+        elements = list()
+        for start,end in chunk:
+            if text.startswith('<___columns', start):
+                headers.append(text[start:end])
+            else:
+                elements.append(text[start:end])
+        jobs.append( ''.join( ['<ModelData>'] + headers + elements
+                              + ['</ModelData>'] ) )
+    return jobs
+
+
+def _import_job(text):
+    '''Parse the text of a job from _import_jobs. Return a list of
+    (class path, decoded, rows) and a list of (class path, pks to
+    delete). rows are the (attributes dict, refs) of each object, from
+    _decode_model_xml, or their xml if decoded is False, for classes
+    with their own from_xml or xml_to_attribs.'''
+    context = _new_import_context()
+    by_class = collections.OrderedDict()
+    _collect_top_level_xml(ET.fromstring(text), by_class, context)
+    classes = list()
+    for cls,xmls in by_class.items():
+        plan = _model_plan(cls)
+        if plan.from_xml or plan.xml_to_attribs:
+            classes.append( (plan.name, False,
+                             [ xml_to_string(xml) for xml in xmls ]) )
+        else:
+            classes.append( (plan.name, True,
+                             [ _decode_model_xml(plan, xml) for xml in xmls ]) )
+    deleted = [ (_path_to_class(cls), list(pks))
+                for cls,pks in context['deleted'].items() ]
+    return classes, deleted
+
+
+def _decode_model_xml(plan, xml):
+    '''Decode the xml of one object without using the db. Returns a
+    dict of its field values and a dict of its ForeignKey field names
+    to the (class path, pk in the xml) that they refer to. Nested
+    objects are ignored; they are loaded separately.'''
+    attributes_dict = dict()
+    refs = dict()
+    for elem in xml:
+        typ = elem.get('type')
+        if elem.tag.startswith('__') or typ is None:
+            continue
+        if typ == 'reference':
+            refs[elem.tag] = (elem.get('to_type'), int(elem.text))
+        elif '.' in typ:
+            pk_name = _model_plan_for_path(typ).cls._meta.pk.name
+            refs[elem.tag] = (typ, int(elem.find(pk_name).text))
+        else:
+            decode = plan.decoders.get((elem.tag, typ))
+            if decode is not None:
+                attributes_dict[elem.tag] = decode(elem.text)
+            else:
+                attributes_dict[elem.tag] = _xml_to_field(elem, None, elem.tag)
+    return attributes_dict, refs
+
+
+def _add_decoded(cls, attributes_dict, refs, context):
+    '''Queue an object decoded by _decode_model_xml for bulk_create,
+    resolving its references from the index of loaded objects.'''
+    fixups = list()
+    for fieldname,(path,old_pk) in refs.items():
+        ref_cls = _model_plan_for_path(path).cls
+        pk = context['imported'][ref_cls].get(old_pk)
+        if pk is None:
+            pk = old_pk
+            fixups.append( (fieldname, ref_cls, old_pk) )
+        attributes_dict[cls._meta.get_field(fieldname).attname] = pk
+    obj = _bulk_add(cls, attributes_dict, context)
+    old_pk = attributes_dict.get(cls._meta.pk.name, obj.pk)
+    context['imported'][cls][old_pk] = obj.pk
+    context['fixups'].extend( (obj,) + fixup for fixup in fixups )
+    _count(context, cls, 'rows')
+    _count(context, cls, 'fixups', len(fixups))
+
+
+def _collect_model_xml(xml, by_class):
+    '''Add the xml of an object, and of the objects nested in it (owned
+    or referred to), to the lists in by_class, which is keyed by class.
+    Classes with a from_xml are expected to load what they contain.'''
+    # A stack rather than recursion, keeping the document order.
+    pending = [ xml ]
+    while pending:
+        xml = pending.pop()
+        plan = _model_plan_for_path(xml.get('type', xml.tag))
+        by_class.setdefault(plan.cls, list()).append(xml)
+        if plan.from_xml:
+            continue
+        nested = list()
+        for elem in xml:
+            if elem.tag == '___owned':
+                nested.extend(elem)
+            elif '.' in elem.get('type', ''):
+                nested.append(elem)
+        pending.extend(reversed(nested))
+
+
+def _iter_elements(xml):
+    '''Yield xml and the elements in it, in document order, like
+    xml.iter() but without recursing for each level of nesting.'''
+    pending = [ xml ]
+    while pending:
+        elem = pending.pop()
+        yield elem
+        pending.extend(reversed(elem))
+
+
+def xml_stream_to_models(source, bulk=False, batch_size=_BULK_BATCH_SIZE,
+                         mode='create', delete_missing=False, stats=None,
+                         on_progress=None, progress_every=_PROGRESS_EVERY):
+    '''Like xml_to_models, but the xml is parsed incrementally from
+    source, which may be a filename or a file object. Each top level
+    object is discarded as soon as it, and the objects it owns, have
+    been loaded so that the whole document is never held in memory.
+    The totals passed to on_progress are None, as the xml has not been
+    read yet.
+    '''
+    progress = _new_progress(on_progress, progress_every, dict)
+    context = _new_import_context(bulk, batch_size, mode, delete_missing,
+                                  stats, progress)
+    root  = None
+    depth = 0
+    with _collecting(stats), transaction.atomic():
+        for event,elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                    assert root.tag == 'ModelData'
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                _load_top_level_xml(elem, context)
+                _run_import_postprocess(context)
+                elem.clear()
+                root.clear()
+        _finish_import(context)
+        _finish_progress(context)
+
+
+def _new_import_context(bulk=False, batch_size=_BULK_BATCH_SIZE,
+                        mode='create', delete_missing=False, stats=None,
+                        progress=None):
+    assert mode in ('create', 'merge'), mode
+    assert mode == 'merge' or not delete_missing
+    if mode == 'merge':
+        bulk = True     # Rows are matched up a batch at a time.
+    return dict( postprocess  = collections.deque()
+               , pp_needs_obj = list()
+               # Class to {pk in the xml: pk in the db} of loaded objects.
+               , imported     = collections.defaultdict(dict)
+               # (obj, field name, class, pk in the xml) of references
+               # which were not loaded yet when obj was.
+               , fixups       = list()
+               # Class to objects waiting for bulk_create, or None.
+               , bulk         = collections.OrderedDict() if bulk else None
+               , batch_size   = batch_size
+               # True if the nested objects are loaded separately.
+               , ordered      = False
+               , mode         = mode
+               , delete_missing = delete_missing
+               # Class to pks to delete once everything is loaded.
+               , deleted      = collections.defaultdict(set)
+               # xml to the object loaded from it, of objects written in
+               # place of a ForeignKey (see _load_nested_first).
+               , nested       = dict()
+               # ___columns id to (class path, columns) in compact xml.
+               , columns      = dict()
+               , stats        = stats
+               , progress     = progress
+               )
+
+
+def _bulk_add(cls, attributes_dict, context):
+    obj = cls(**attributes_dict)
+    if obj.pk is None:
+        # There is no row to merge it with, and bulk_create would not
+        # tell us the primary key it gets. Insert it as the non bulk
+        # import does, after the rows which it may refer to.
+        _flush_bulk(context)
+        _reset_sequences([cls])
+        obj.save(force_insert=True)
+        return obj
+    pending = context['bulk'].setdefault(cls, list())
+    pending.append(obj)
+    if len(pending) >= context['batch_size']:
+        _flush_bulk(context)
+    return obj
+
+
+def _flush_bulk(context):
+    '''Insert all the objects that are waiting. Classes are inserted in
+    the order in which they were first seen, which for xml written by
+    models_to_xml puts referenced rows before the rows referring to them.
+    '''
+    for cls,pending in context['bulk'].items():
+        if pending:
+            with _charging(context, cls):
+                if context['mode'] == 'merge':
+                    _merge_rows(cls, pending, context['batch_size'])
+                else:
+                    cls.objects.bulk_create(pending,
+                                            batch_size=context['batch_size'])
+            del pending[:]
+
+
+def _merge_rows(cls, objs, batch_size):
+    '''Insert the objects which are not in the db yet, and update the
+    fields that differ for those which are. Updates which set the same
+    values are done together, as Django has no bulk update.'''
+    attnames = [ f.attname for f in cls._meta.fields if not f.primary_key ]
+    existing = dict()
+    for chunk in _chunks([ obj.pk for obj in objs ], _PREFETCH_BATCH_SIZE):
+        for row in cls.objects.filter(pk__in=chunk) \
+                              .values_list('pk', *attnames):
+            existing[row[0]] = row[1:]
+
+    inserts = list()
+    updates = collections.defaultdict(list)
+    for obj in objs:
+        row = existing.get(obj.pk)
+        if row is None:
+            inserts.append(obj)
+            continue
+        changes = tuple( (attname, getattr(obj, attname))
+                         for attname,value in zip(attnames, row)
+                         if getattr(obj, attname) != value )
+        if changes:
+            updates[changes].append(obj.pk)
+
+    if inserts:
+        cls.objects.bulk_create(inserts, batch_size=batch_size)
+    for changes,pks in updates.items():
+        for chunk in _chunks(pks, _PREFETCH_BATCH_SIZE):
+            cls.objects.filter(pk__in=chunk).update(**dict(changes))
+
+
+def _finish_import(context):
+    if context['bulk'] is not None:
+        _flush_bulk(context)
+    _apply_reference_fixups(context)
+    _apply_deletions(context)
+    if context['bulk'] is None:
+        return
+    # The primary keys were given explicitly, so sequences (on backends
+    # that have them) need to be moved past them.
+    _reset_sequences(list(context['bulk']))
+
+
+def _reset_sequences(classes):
+    sql = connection.ops.sequence_reset_sql(no_style(), classes)
+    if sql:
+        cursor = connection.cursor()
+        for statement in sql:
+            cursor.execute(statement)
+
+
+def _apply_deletions(context):
+    '''Delete the rows listed in ___deleted elements and, if
+    delete_missing was given, the rows which were not loaded. Classes
+    are done in reverse dependency order.'''
+    delete_missing = context['delete_missing']
+    if delete_missing is True:
+        missing = set(context['imported'])
+    elif delete_missing:
+        missing = set( cls for level in model_dependency_levels(delete_missing)
+                       for cls in level )
+    else:
+        missing = set()
+    classes = set(context['deleted']) | missing
+    for level in reversed(_dependency_levels(list(classes))):
+        for cls in level:
+            pks = set(context['deleted'].get(cls, ()))
+            if cls in missing:
+                keep = set(context['imported'].get(cls, dict()).values())
+                pks.update( pk for pk in cls.objects.values_list('pk',
+                                                                 flat=True)
+                            if pk not in keep )
+            with _charging(context, cls):
+                for chunk in _chunks(sorted(pks), _PREFETCH_BATCH_SIZE):
+                    cls.objects.filter(pk__in=chunk).delete()
+
+
+def _run_import_postprocess(context):
     while context['postprocess']:
-        fn = context['postprocess'].pop(0)
+        fn = context['postprocess'].popleft()
         fn()
 
 
+def _apply_reference_fixups(context):
+    '''Check the references which were made before the objects they
+    refer to had been loaded, and update any whose object ended up with
+    a different pk. The updates are grouped per class, field and pk.'''
+    updates = collections.defaultdict(list)
+    missing = collections.defaultdict(set)
+    for obj,fieldname,cls,old_pk in context['fixups']:
+        pk = context['imported'][cls].get(old_pk)
+        if pk is None:
+            missing[cls].add(old_pk)
+        elif pk != old_pk:
+            attname = obj._meta.get_field(fieldname).attname
+            updates[(obj.__class__, attname, pk)].append(obj.pk)
+    del context['fixups'][:]
+
+    for cls,old_pks in missing.items():
+        found = set()
+        for chunk in _chunks(old_pks, _PREFETCH_BATCH_SIZE):
+            found.update( cls.objects.filter(pk__in=chunk)
+                                     .values_list('pk', flat=True) )
+        if old_pks - found:
+            raise Exception('Could not find {!r} objects with pks {!r}'
+                            .format(cls, sorted(old_pks - found)))
+
+    for (cls,attname,pk),pks in sorted(updates.items()):
+        with _charging(context, cls):
+            for chunk in _chunks(pks, _PREFETCH_BATCH_SIZE):
+                cls.objects.filter(pk__in=chunk).update(**{attname:pk})
+
+
 def xml_to_model(xml, context, delegate=True):
     '''Only contents and attribs of xml node are used, not tag.
     If delegate is True (the default) it will try to delegate
@@ -333,33 +2242,74 @@ def xml_to_model(xml, context, delegate=True):
     If False, it will force it to be handled in this function.'''
     assert isinstance(xml, ET.Element)
 
-    context['pp_needs_obj'].append(list())
+    plan = _model_plan_for_path(xml.get('type', xml.tag))
+    cls = plan.cls
+    if not (delegate and plan.from_xml):
+        _load_nested_first(xml, context)
 
-    class_pathname = xml.get('type', xml.tag)
-    cls = _get_class_from_class_pathname(class_pathname)
+    context['pp_needs_obj'].append(list())
 
-    if delegate and hasattr(cls, 'from_xml'):
-        return cls.from_xml(xml, context)
+    _row_done(context, cls)
+    with _charging(context, cls):
+        if delegate and plan.from_xml:
+            return cls.from_xml(xml, context)
 
-    attributes_dict = _xml_to_attribs(cls, xml, context)
-    obj = cls.objects.create( **attributes_dict )
+        attributes_dict = _xml_to_attribs(cls, xml, context)
+        if context.get('bulk') is None:
+            obj = cls.objects.create( **attributes_dict )
+        else:
+            obj = _bulk_add(cls, attributes_dict, context)
+    old_pk = attributes_dict.get(cls._meta.pk.name, obj.pk)
+    context['imported'][cls][old_pk] = obj.pk
 
     pps = context['pp_needs_obj'].pop()
     for pp in pps:
-        context['postprocess'].append( lambda: pp(obj) )
+        context['postprocess'].append( lambda pp=pp: pp(obj) )
 
     return obj
 
 
+def _load_nested_first(xml, context):
+    '''Load the objects written in place of the ForeignKeys of xml, and
+    those written in place in them and so on, deepest first, and keep
+    them in context['nested'] for _xml_to_field. Loading them as the
+    fields are decoded would recurse once per level, and a long chain of
+    them would run into the recursion limit. Classes which decode their
+    own xml are left to do so.'''
+    if context.get('ordered'):
+        return      # They are only references, loaded separately.
+    nested = list()
+    pending = [ xml ]
+    while pending:
+        elem = pending.pop()
+        plan = _model_plan_for_path(elem.get('type', elem.tag))
+        if plan.from_xml or plan.xml_to_attribs:
+            continue
+        for child in elem:
+            if '.' in child.get('type', '') and \
+                    child not in context['nested']:
+                nested.append(child)
+                pending.append(child)
+    for elem in reversed(nested):
+        context['nested'][elem] = xml_to_model(elem, context)
+
+
 def _xml_to_attribs(cls, xml, context, delegate=True):
     '''Return a dictionary of all the attributes for an instance of
     this class, as indicated by the xml. Keys preceded by exactly two
     underscores (such as "__version") are presumed to be for
     consumption by the class and are ignored.'''
 
-    if delegate and hasattr(cls, 'xml_to_attribs'):
+    plan = _model_plan(cls)
+    if delegate and plan.xml_to_attribs:
         return cls.xml_to_attribs(xml, context)
 
+    with _charging(context, cls, 'field_seconds'):
+        return _decode_attribs(plan, xml, context)
+
+
+def _decode_attribs(plan, xml, context):
+    decoders = plan.decoders
     ret = dict()
     for elem in xml:
         if elem.tag.startswith('__') and not elem.tag.startswith('___'):
@@ -372,8 +2322,13 @@ def _xml_to_attribs(cls, xml, context, delegate=True):
         if typ is not None:
             assert elem.tag not in ret, \
                     'Found tag name {} listed twice.'.format(elem.tag)
-            val = _xml_to_field(elem, context, elem.tag)
-            ret[elem.tag] = val
+            decode = decoders.get((elem.tag, typ))
+            if decode is not None:
+                ret[elem.tag] = decode(elem.text)
+            else:
+                ret[elem.tag] = _xml_to_field(elem, context, elem.tag)
+        elif context.get('ordered'):
+            assert elem.tag == '___owned'   # Loaded separately.
         else:
             assert elem.tag == '___owned'
             # Create post process step for these objects. They will
@@ -388,65 +2343,44 @@ def _xml_to_attribs(cls, xml, context, delegate=True):
 
 def _xml_to_field(xml, context, fieldname):
     typ = xml.get('type', xml.tag)
-    if '.' in typ:
-        return xml_to_model(xml, context)
-    elif typ == 'int':
-        return int(xml.text)
-    elif typ == 'str':
-        return str(xml.text)
-    elif typ == 'unicode':
-        return unicode(xml.text)
-    elif typ == 'datetime':
-        return _str_to_datetime(xml.text)
-    elif typ == 'date':
-        return datetime.date(*[int(x) for x in xml.text.split('-')])
-    elif typ == 'float':
-        return float(xml.text)
-    elif typ == 'buffer':
-        return base64.b64decode(xml.text)
-    elif typ == 'bool':
-        return {'True':True, 'False':False}[xml.text]
+    decode = _codecs_by_tag.get(typ)
+    if decode is not None:
+        return decode(xml.text)
+    elif '.' in typ:
+        if context.get('ordered'):
+            # It is loaded separately, so this is just a reference.
+            cls = _model_plan_for_path(typ).cls
+            old_pk = int(xml.find(cls._meta.pk.name).text)
+            return _xml_reference(cls, old_pk, context, fieldname)
+        obj = context['nested'].pop(xml, None)
+        if obj is None:
+            obj = xml_to_model(xml, context)
+        return obj
     elif typ == 'reference':
-        cls = _get_class_from_class_pathname(xml.get('to_type'))
-        kwargs = { cls._meta.pk.attname : int(xml.text) }
-        objs = cls.objects.filter(**kwargs)
-        assert len(objs) in (0,1)
-        if len(objs)==1:
-            return objs[0]
-        # Try again later.
-        def fn(obj, fieldname=fieldname, cls=cls, kwargs=kwargs):
-            objs = cls.objects.filter(**kwargs)
-            assert len(objs) in (0,1)
-            if len(objs)==1:
-                setattr(obj, fieldname, objs[0])
-            # Still not available. It is probably best that we don't just
-            # throw this on the end of the preprocess stack and try again
-            # later.
-            else:
-                raise Exception(('Still could not find object'
-                                ' {!r} {!r} to fill out {!r}.{}').format(
-                                    cls, kwargs, obj, field_name)
-                               )
-
-        context['postprocess'].append( fn )
-
-            # Need some additional context. Which object is being
-            # worked on so that I can fixup in the postprocess.
-            # Probably need to add fixup fns which take the object and then 
-            # at the end of importing I can wrap those with something which
-            # passes the object that these attributes are applied to.
-            # In extreme cases I may have to create a dummy object until we
-            # can load the real one, but we can't guarantee a way out of
-            # manual intervention, as a default object may not exist that
-            # behaves properly for more than one referent.
-            # I'll just support a None for now.
-
-        return None
+        cls = _model_plan_for_path(xml.get('to_type')).cls
+        return _xml_reference(cls, int(xml.text), context, fieldname)
 
     raise Exception('Unknown type: {0} {1.tag} {1.text}'.format(typ, xml))
     return _etn(k, type=type(v).__name__, text='NYI')
 
 
+def _xml_reference(cls, old_pk, context, fieldname):
+    '''Return a value for a ForeignKey to the cls object which had
+    old_pk in the xml.'''
+    pk = context['imported'][cls].get(old_pk)
+    if pk is None:
+        # Not loaded yet, or it was in the db already. Primary keys
+        # are normally kept, so refer to the same pk and check it
+        # once everything has been loaded.
+        pk = old_pk
+        def fn(obj, fieldname=fieldname, cls=cls, old_pk=old_pk):
+            context['fixups'].append( (obj, fieldname, cls, old_pk) )
+            _count(context, obj.__class__, 'fixups')
+        context['pp_needs_obj'][-1].append( fn )
+    # An object with just the pk is enough to fill in the ForeignKey.
+    return cls(**{ cls._meta.pk.attname : pk })
+
+
 #class SerializableMixin(object):
 
 #    def to_xml(self, context, name):
@@ -3,9 +3,12 @@
 
 import logging
 import os
+import sys
+from   xml.etree import ElementTree as ET
 
 from   django.test import TestCase
 from   utils import LoggingFilterContext, TemporaryFileContext
+from   utils import indent_xml, write_indented_xml, xml_to_string
 
 
 class TestLoggingFilter(TestCase):
@@ -86,3 +89,56 @@ class TestTemporaryFileContext(TestCase):
         self.assertFalse( os.access(fname, os.R_OK) )
 
 
+class TestIndentXml(TestCase):
+    xml = ( '<a><b x="1" c="&lt;&#10;"><c>Spam &amp; Eggs</c><d /></b>'
+            '<e><f><g /></f></e><h /></a>' )
+
+    def test_indent_xml(self):
+        self.assertEquals( '<?xml version="1.0" ?>\n'
+                           '<a>\n'
+                           '  <b c="&lt;&#10;" x="1">\n'
+                           '    <c>Spam &amp; Eggs</c>\n'
+                           '    <d/>\n'
+                           '  </b>\n'
+                           '  <e><f><g/></f></e>\n'
+                           '  <h/>\n'
+                           '</a>\n'
+                         , indent_xml(self.xml) )
+        self.assertEquals( '<?xml version="1.0" ?>\n'
+                           '<e>\n'
+                           '  <f>\n'
+                           '    <g/>\n'
+                           '  </f>\n'
+                           '</e>\n'
+                         , indent_xml('<e><f><g /></f></e>',
+                                      collapse_leaves=False) )
+        # Indenting again changes nothing.
+        self.assertEquals( indent_xml(self.xml)
+                         , indent_xml(indent_xml(self.xml)) )
+
+    def test_write_indented_xml(self):
+        with TemporaryFileContext('') as tempfile:
+            with open(tempfile.fileName(), 'wb') as f:
+                write_indented_xml(u'<a>caf\u00e9</a>', f, encoding='utf-8')
+            self.assertEquals( '<?xml version="1.0" ?>\n<a>caf\xc3\xa9</a>\n'
+                             , open(tempfile.fileName(), 'rb').read() )
+
+    def test_deep_nesting(self):
+        xml = root = ET.Element('a')
+        for i in xrange(sys.getrecursionlimit() + 100):
+            xml = ET.SubElement(xml, 'b', x='1')
+        xml.text = 'c'
+        lines = indent_xml(xml_to_string(root),
+                           collapse_leaves=False).splitlines()
+        self.assertEquals('  <b x="1">', lines[2])
+        self.assertEquals('</a>', lines[-1])
+
+
+class TestXmlToString(TestCase):
+
+    def test_xml_to_string(self):
+        xml = ET.fromstring(TestIndentXml.xml)
+        xml[0].set('y', u'caf\u00e9 "\n"')
+        xml[1].append(ET.Comment('note'))
+        xml[1].tail = 'tail & more'
+        self.assertEquals(ET.tostring(xml), xml_to_string(xml))
@@ -6,6 +6,7 @@ import os
 import re
 import tempfile
 import time
+from   StringIO import StringIO
 from   xml.etree import ElementTree as ET
 
 
@@ -83,21 +84,165 @@ class LoggingFilterContext(logging.Filter, EnableAsDecorator):
         logger.removeFilter(self)
 
 
-def indent_xml(xml, collapse_leaves=True):
-    from xml.dom.minidom import parseString
-    doc = parseString( xml if isinstance(xml,basestring) else ET.tostring(xml) )
-    xml = doc.toprettyxml('  ')
-    if collapse_leaves:
-        lines = xml.split('\n')
-        i = 2
-        regex = re.compile('^(\s*)')
-        while i < len(lines):
-            wslen = [ len(regex.match(lines[i-ii]).group(1)) for ii in (2,1,0) ]
-            if wslen[0]==wslen[2] and wslen[1] > wslen[0]:
-                lines[i-2] = lines[i-2] + lines[i-1].strip() + lines[i].strip()
-                del lines[i-1:i+1]
-                i -= 2
-            i += 1
-        xml = '\n'.join(lines)
-    return xml
+def xml_to_string(elem):
+    '''Return elem as a string of xml, the same as ET.tostring does, but
+    without recursing for each level of nesting, so that deeply nested
+    elements can be written.'''
+    out = list()
+    write = out.append
+    pending = [ elem ]
+    while pending:
+        elem = pending.pop()
+        if isinstance(elem, tuple):
+            # The end of an element whose children have been written.
+            elem = elem[0]
+            write('</' + elem.tag + '>')
+        elif elem.tag is ET.Comment:
+            write('<!--%s-->' % _encode_xml(elem.text))
+        elif elem.tag is ET.ProcessingInstruction:
+            write('<?%s?>' % _encode_xml(elem.text))
+        else:
+            write('<' + elem.tag + ''.join(
+                    ' %s="%s"' % (name, _escape_xml_string(value,
+                                                _XML_STRING_ATTRIB_ESCAPES))
+                    for name,value in sorted(elem.items()) ))
+            if elem.text or len(elem):
+                write('>')
+                if elem.text:
+                    write(_escape_xml_string(elem.text, _XML_CDATA_ESCAPES))
+                pending.append( (elem,) )
+                pending.extend(reversed(elem))
+                continue
+            write(' />')
+        if elem.tail:
+            write(_escape_xml_string(elem.tail, _XML_CDATA_ESCAPES))
+    return ''.join(out)
+
 
+def indent_xml(xml, collapse_leaves=True):
+    '''Return xml, an Element or a string of xml, as a string indented
+    by two spaces per level. See write_indented_xml.'''
+    out = StringIO()
+    write_indented_xml(xml, out, collapse_leaves)
+    return out.getvalue()
+
+
+def write_indented_xml(xml, fileobj, collapse_leaves=True, encoding=None):
+    '''Write xml, an Element or a string of xml, to fileobj indented by
+    two spaces per level, in one pass over the tree. An element with no
+    children is written on one line. If collapse_leaves is True an
+    element whose only child fits on one line is also written on one
+    line with it. Whitespace between elements is not kept. If encoding
+    is given the text is encoded before it is written; otherwise
+    fileobj is given unicode when the xml is not ascii.'''
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    if isinstance(xml, str):
+        xml = ET.fromstring(xml)
+    write = fileobj.write
+    if encoding is not None:
+        write = lambda text: fileobj.write(text.encode(encoding))
+    write('<?xml version="1.0" ?>\n')
+    _write_indented_element(xml, write, '', collapse_leaves)
+
+
+def _write_indented_element(root, write, indent, collapse_leaves):
+    # The elements whose children are being written are kept on a stack,
+    # with their indents and iterators over their children, rather than
+    # recursing, so that deep trees do not run into the recursion limit.
+    stack = list()
+    elem = root
+    while True:
+        if _fits_on_line(elem, collapse_leaves):
+            write(indent + _element_on_line(elem) + '\n')
+            done = elem
+        else:
+            write(indent + _start_tag(elem) + '>\n')
+            if _significant(elem.text):
+                write(indent + '  ' + _escape_xml_text(elem.text) + '\n')
+            stack.append( (elem, indent, iter(elem)) )
+            done = None
+        # Write the tails and end tags of the elements which are finished,
+        # up to the next element to start.
+        while True:
+            if done is not None and done is not root and \
+                    _significant(done.tail):
+                write(indent + _escape_xml_text(done.tail) + '\n')
+            if not stack:
+                return
+            parent, parent_indent, children = stack[-1]
+            elem = next(children, None)
+            if elem is not None:
+                indent = parent_indent + '  '
+                break
+            stack.pop()
+            write(parent_indent + '</' + parent.tag + '>\n')
+            done, indent = parent, parent_indent
+
+
+def _fits_on_line(elem, collapse_leaves):
+    while len(elem):
+        if not collapse_leaves or len(elem) > 1 or \
+                _significant(elem.text) or _significant(elem[0].tail):
+            return False
+        elem = elem[0]
+    return True
+
+
+def _element_on_line(elem):
+    # A chain of only children, as checked by _fits_on_line.
+    chain = [ elem ]
+    while len(chain[-1]):
+        chain.append(chain[-1][0])
+    leaf = chain.pop()
+    if leaf.text:
+        inner = _start_tag(leaf) + '>' + _escape_xml_text(leaf.text) + \
+                '</' + leaf.tag + '>'
+    else:
+        inner = _start_tag(leaf) + '/>'
+    return ( ''.join( _start_tag(e) + '>' for e in chain ) + inner +
+             ''.join( '</' + e.tag + '>' for e in reversed(chain) ) )
+
+
+def _start_tag(elem):
+    return '<' + elem.tag + ''.join(
+                    ' %s="%s"' % (name, _escape_xml_attrib(value))
+                    for name,value in sorted(elem.items()) )
+
+
+def _significant(text):
+    return text is not None and text.strip() != ''
+
+
+_XML_TEXT_ESCAPES   = [ ('&', '&amp;'), ('<', '&lt;'), ('"', '&quot;')
+                      , ('>', '&gt;') ]
+_XML_ATTRIB_ESCAPES = _XML_TEXT_ESCAPES + [ ('\n', '&#10;'), ('\r', '&#13;')
+                                          , ('\t', '&#9;') ]
+
+# As escaped by ET.tostring, which leaves the text to be encoded as ascii
+# with character references.
+_XML_CDATA_ESCAPES  = [ ('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;') ]
+_XML_STRING_ATTRIB_ESCAPES = _XML_CDATA_ESCAPES + [ ('"', '&quot;')
+                                                  , ('\n', '&#10;') ]
+
+def _escape_xml_string(text, escapes):
+    for char,escaped in escapes:
+        if char in text:
+            text = text.replace(char, escaped)
+    return _encode_xml(text)
+
+
+def _encode_xml(text):
+    return text.encode('us-ascii', 'xmlcharrefreplace')
+
+
+def _escape_xml_text(text):
+    for char,escaped in _XML_TEXT_ESCAPES:
+        text = text.replace(char, escaped)
+    return text
+
+
+def _escape_xml_attrib(text):
+    for char,escaped in _XML_ATTRIB_ESCAPES:
+        text = text.replace(char, escaped)
+    return text
@@ -0,0 +1,118 @@
+# A small queue of jobs that are run one at a time by a thread in this
+# process, so that a request can start something slow, such as loading a
+# large dump, and return straight away. The jobs are only known to the
+# process that runs them, so with several server processes the job must
+# be polled for on the same one. Finished jobs are forgotten once there
+# are more than _KEEP_FINISHED of them.
+
+import collections
+import itertools
+import logging
+import Queue
+import threading
+import time
+
+from   django.db import connection
+
+
+_KEEP_FINISHED = 100
+
+
+class Job(object):
+    '''A job that has been submitted to a JobQueue. state is 'queued',
+    'running', 'done' or 'failed'. counts maps model class paths to
+    dicts of rows done and total rows, as reported through on_progress.
+    '''
+
+    def __init__(self, job_id, fn):
+        self.id       = job_id
+        self.fn       = fn
+        self.state    = 'queued'
+        self.counts   = collections.OrderedDict()
+        self.error    = None
+        self.created  = time.time()
+        self.started  = None
+        self.finished = None
+
+    def on_progress(self, cls, done, total):
+        '''For use as the on_progress callback of the serializable
+        functions.'''
+        path = '.'.join([cls.__module__, cls.__name__])
+        self.counts[path] = dict(done=done, total=total)
+
+    def status(self):
+        '''Return a dict describing the job, which can be sent as json.'''
+        return dict( id       = self.id
+                   , state    = self.state
+                   , counts   = self.counts
+                   , error    = self.error
+                   , created  = self.created
+                   , started  = self.started
+                   , finished = self.finished
+                   )
+
+
+class JobQueue(object):
+    '''Runs submitted jobs one at a time. If threaded is True they are
+    run by a thread which is started when the first job is submitted.
+    Otherwise they wait until run_pending is called, which tests use.'''
+
+    def __init__(self, threaded=True):
+        self.threaded = threaded
+        self._jobs    = collections.OrderedDict()
+        self._ids     = itertools.count(1)
+        self._queue   = Queue.Queue()
+        self._lock    = threading.Lock()
+        self._thread  = None
+
+    def submit(self, fn):
+        '''Queue fn to be called as fn(job), and return the Job.'''
+        with self._lock:
+            job = Job(str(next(self._ids)), fn)
+            self._jobs[job.id] = job
+            self._forget_finished()
+            if self.threaded and self._thread is None:
+                self._thread = threading.Thread(target=self._work,
+                                                name='JobQueue')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        '''Return the job with the given id, or None.'''
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def run_pending(self):
+        while not self._queue.empty():
+            self._run(self._queue.get())
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            finally:
+                # Each thread has its own connection, which Django only
+                # closes at the end of requests.
+                connection.close()
+
+    def _run(self, job):
+        job.state   = 'running'
+        job.started = time.time()
+        try:
+            job.fn(job)
+        except Exception as e:
+            logging.exception('Job %s failed.', job.id)
+            job.error = '{}: {}'.format(e.__class__.__name__, e)
+            job.state = 'failed'
+        else:
+            job.state = 'done'
+        job.finished = time.time()
+
+    def _forget_finished(self):
+        finished = [ job_id for job_id,job in self._jobs.items()
+                     if job.finished is not None ]
+        for job_id in finished[:max(0, len(finished) - _KEEP_FINISHED)]:
+            del self._jobs[job_id]
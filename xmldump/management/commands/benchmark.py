@@ -0,0 +1,224 @@
+# Measure how long serializable takes to export and import synthetic
+# datasets of various sizes. For example:
+#       python manage.py benchmark --rows 10000 --rows 100000 -o bench.jsonl
+#
+# The data is generated in a test database, named after the normal one
+# with a benchmark_ prefix, which is created for the run and destroyed
+# afterwards. So neither the normal database nor that of a test run going
+# on at the same time is touched. A line of json is written for each step
+# of each size, so the results of runs at different times can be compared.
+
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import traceback
+from   optparse import make_option
+from   xml.etree import ElementTree as ET
+
+from   django.core.management.base import BaseCommand
+from   django.db import connection, connections, transaction
+
+from   serializable import models_to_xml, xml_to_models, \
+                          delete_all_models_in_db, QueryCounter
+from   utils import indent_xml
+from   xmldump.models import Menu, MenuItem, Order, OrderEntry
+
+
+# The shape of the generated data.
+_ITEMS_PER_MENU    = 25
+_ROWS_PER_MENU     = 1000
+_ENTRIES_PER_ORDER = 4
+
+_INSERT_BATCH_SIZE = 500
+
+
+def generate_dataset(rows, seed=0):
+    '''Fill the empty xmldump tables with about rows rows of made up
+    data. The same seed always produces the same data. Returns a dict of
+    model class to the number of rows created.'''
+    rnd = random.Random(seed)
+    menus  = max(1, rows // _ROWS_PER_MENU)
+    items  = menus * _ITEMS_PER_MENU
+    orders = max(1, (rows - menus - items) // (1 + _ENTRIES_PER_ORDER))
+    today  = datetime.date.today()
+
+    def entries():
+        pk = 0
+        for order in xrange(1, orders+1):
+            for menuitem in rnd.sample(xrange(1, items+1),
+                                       min(items, _ENTRIES_PER_ORDER)):
+                pk += 1
+                yield OrderEntry( id=pk, order_id=order, menuitem_id=menuitem
+                                , count=rnd.randint(1, 5) )
+
+    # Primary keys are given explicitly so that the rows can refer to
+    # each other without reading them back.
+    with transaction.atomic():
+        _insert(Menu, ( Menu(id=pk, name='Menu %d' % pk)
+                        for pk in xrange(1, menus+1) ))
+        _insert(MenuItem, ( MenuItem( id=pk, menu_id=(pk-1) % menus + 1
+                                    , name='Item %d' % pk
+                                    , price=rnd.randint(100, 2000) / 100.0 )
+                            for pk in xrange(1, items+1) ))
+        _insert(Order, ( Order( id=pk, customer='Customer %d' % pk
+                              , date=today - datetime.timedelta(pk % 1000) )
+                         for pk in xrange(1, orders+1) ))
+        _insert(OrderEntry, entries())
+    return dict( (cls, cls.objects.count())
+                 for cls in (Menu, MenuItem, Order, OrderEntry) )
+
+
+def _insert(cls, objs):
+    batch = list()
+    for obj in objs:
+        batch.append(obj)
+        if len(batch) == _INSERT_BATCH_SIZE:
+            cls.objects.bulk_create(batch)
+            batch = list()
+    if batch:
+        cls.objects.bulk_create(batch)
+
+
+def _measure(fn):
+    '''Call fn, which returns the number of bytes it produced or
+    consumed, and return a dict of measurements. fn is run in a forked
+    child, so that peak_rss_kb is the peak of that step alone rather
+    than of everything this process has done, and anything fn leaves
+    behind other than in the db is lost. The db connections are closed
+    first, so this must not be called inside a transaction.'''
+    assert not any( conn.in_atomic_block for conn in connections.all() )
+    for conn in connections.all():
+        conn.close()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 1
+        try:
+            with QueryCounter() as queries:
+                start = time.time()
+                size = fn()
+                seconds = time.time() - start
+            for conn in connections.all():
+                conn.close()
+            os.write(write_fd, json.dumps(dict( seconds = round(seconds, 3)
+                                              , queries = queries.queries
+                                              , bytes   = size
+                                              )))
+            code = 0
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        data = pipe.read()
+    pid, status, rusage = os.wait4(pid, 0)
+    if status != 0:
+        raise Exception('The benchmark step failed, with status %d' % status)
+    result = json.loads(data)
+    # ru_maxrss is in kilobytes on Linux but in bytes on OS X.
+    result['peak_rss_kb'] = rusage.ru_maxrss // 1024 \
+                                if sys.platform == 'darwin' else rusage.ru_maxrss
+    return result
+
+
+def run_benchmark(rows, seed=0, bulk=False):
+    '''Yield a dict of results for each step of exporting, indenting,
+    deleting and reimporting a dataset of about rows rows. The tables
+    must be empty to start with, and are left full.'''
+    roots = [Menu, Order]
+    counts = generate_dataset(rows, seed)
+    common = dict( rows    = sum(counts.values())
+                 , seed    = seed
+                 , started = datetime.datetime.utcnow().isoformat()
+                 )
+    # Each step runs in a child process (see _measure), so the export is
+    # passed on to the later steps in a file.
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    os.close(fd)
+    state = dict()
+
+    def export():
+        text = ET.tostring(models_to_xml(roots))
+        with open(path, 'wb') as f:
+            f.write(text)
+        return len(text)
+
+    def indent():
+        return len(indent_xml(state['xml']))
+
+    def delete():
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db(roots)
+        return None
+
+    def load():
+        xml_to_models(state['xml'], bulk=bulk)
+        return os.path.getsize(path)
+
+    try:
+        for name,fn in ( ('models_to_xml'           , export)
+                       , ('indent_xml'              , indent)
+                       , ('delete_all_models_in_db' , delete)
+                       , ('xml_to_models'           , load)
+                       ):
+            result = dict(common, operation=name)
+            result.update(_measure(fn))
+            yield result
+            if fn is export:
+                state['xml'] = ET.parse(path).getroot()
+    finally:
+        os.remove(path)
+
+    loaded = dict( (cls, cls.objects.count()) for cls in counts )
+    assert loaded == counts, (loaded, counts)
+
+
+class Command(BaseCommand):
+    help = ('Time exporting and importing generated datasets of the given'
+            ' sizes, writing a line of json per step.')
+    option_list = BaseCommand.option_list + (
+        make_option( '--rows', action='append', type='int', dest='rows'
+                   , help='Approximate number of rows to generate. May be'
+                          ' given more than once. Defaults to 10000.' ),
+        make_option( '--seed', type='int', dest='seed', default=0
+                   , help='Seed for the generated data.' ),
+        make_option( '--bulk', action='store_true', dest='bulk', default=False
+                   , help='Import with bulk=True.' ),
+        make_option( '-o', '--output', dest='output'
+                   , help='File to append the results to, instead of'
+                          ' writing them to stdout.' ),
+        )
+
+    def handle(self, *args, **options):
+        sizes = options['rows'] or [10000]
+        out = open(options['output'], 'a') if options['output'] else self.stdout
+        test_settings = connection.settings_dict['TEST']
+        old_test_name = test_settings.get('NAME')
+        name = connection.settings_dict['NAME']
+        test_settings['NAME'] = os.path.join( os.path.dirname(name)
+                                            , 'benchmark_' +
+                                              os.path.basename(name) )
+        try:
+            old_name = connection.creation.create_test_db(verbosity=0,
+                                                          autoclobber=True)
+        finally:
+            test_settings['NAME'] = old_test_name
+        try:
+            for rows in sizes:
+                for result in run_benchmark(rows, options['seed'],
+                                            options['bulk']):
+                    out.write(json.dumps(result, sort_keys=True) + '\n')
+                with delete_all_models_in_db.logging_filter:
+                    delete_all_models_in_db([Menu, Order], fast=True,
+                                            send_signals=False)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if out is not self.stdout:
+                out.close()
@@ -14,12 +14,19 @@
 
 
 import datetime
+import decimal
+import json
 import logging
 import re
+import sys
+import uuid
+from   StringIO import StringIO
 from   xml.etree import ElementTree as ET
 
-from   django.db import models
-from   django.test import TestCase
+from   django.db import connection, connections, models, transaction
+from   django.db.models import signals
+from   django.test import TestCase, TransactionTestCase
+from   django.test.utils import CaptureQueriesContext
 from   django import forms
 
 from   serializable import models_to_xml, xml_to_models, delete_all_models_in_db
@@ -33,6 +40,16 @@ from   models import *
 ###
 
 
+class Node(models.Model):
+    '''A chain of Nodes exported from its leaf nests as deeply as it is
+    long. It is not in an installed app, so that the other tests do not
+    export it; TestDeepNesting makes its table.'''
+    parent = models.ForeignKey('self', null=True)
+
+    class Meta:
+        app_label = 'serializable_tests'
+
+
 class TestHelpers(TestCase):
     def test_datetime_conversions(self):
         self.assertEquals( 'datetime(2014,1,2,3,12,13,1456)'
@@ -42,22 +59,99 @@ class TestHelpers(TestCase):
                          , serializable._str_to_datetime(
                                 'datetime(2014,1,2,3,12,13,1456)'))
 
+    def test_owned_models(self):
+        owned = serializable.owned_models(Menu)
+        self.assertEquals( [MenuItem], [ cls for cls,fn in owned ] )
+        self.assertTrue( owned is serializable.owned_models(Menu) )
+        self.assertEquals( [OrderEntry]
+                         , [ cls for cls,fn in serializable.owned_models(
+                                                MenuItem, delegate=False) ] )
+        self.assertEquals( []
+                         , serializable.owned_models(MenuItem) )
+
+        serializable.clear_caches()
+        self.assertFalse( owned is serializable.owned_models(Menu) )
+
+    def test_model_dependency_levels(self):
+        self.assertEquals( [[Menu, Order], [MenuItem], [OrderEntry]]
+                         , serializable.model_dependency_levels([Menu, Order]) )
+
+    def test_model_plan(self):
+        plan = serializable._model_plan(OrderEntry)
+        self.assertTrue( plan is serializable._model_plan(OrderEntry) )
+        self.assertTrue( plan is serializable._model_plan_for_path(
+                                    'xmldump.models.OrderEntry') )
+        self.assertEquals( ['id', 'order', 'menuitem', 'count']
+                         , [ name for name,fn in plan.encoders ] )
+        self.assertEquals( set([('id','int'), ('count','int')])
+                         , set(plan.decoders) )
+
+    def test_pk_set(self):
+        pks = serializable._PkSet()
+        values = [0, 5, 5, 70000, -1, 10**12, 'spam', None] + range(1000)
+        for pk in values:
+            pks.add(pk)
+        for pk in values:
+            self.assertTrue(pk in pks)
+        for pk in (1000, 69999, 2**40, 'eggs', -2):
+            self.assertFalse(pk in pks)
+        self.assertEquals(1005, len(pks))
+        # Only the keys that are far apart are not in the bitmap.
+        self.assertEquals(set([70000, 10**12, -1, 'spam', None]), pks.others)
+        self.assertEquals(1024//8, len(pks.bits))
+
+    def test_touched(self):
+        touched = serializable._Touched()
+        touched.add(Menu(id=1))
+        self.assertTrue(Menu(id=1) in touched)
+        self.assertFalse(Menu(id=2) in touched)
+        self.assertFalse(Order(id=1) in touched)
+
+    def test_codecs(self):
+        values = [ None, True, 7, 2**70, 1.5, decimal.Decimal('4.50'), ''
+                 , u'Spam \u00e9', datetime.time(7, 30, 15, 20)
+                 , datetime.date(2014, 6, 1)
+                 , uuid.UUID('12345678123456781234567812345678')
+                 , {'spam': [1, 2]} ]
+        for v in values:
+            xml = serializable._field_to_xml(None, 'v', v, {})
+            xml = ET.fromstring(ET.tostring(xml))
+            self.assertEquals(v, serializable._xml_to_field(xml, {}, 'v'))
+
+        class Spam(object):
+            def __init__(self, n):
+                self.n = n
+        serializable.register_codec( Spam, 'spam', lambda v: str(v.n)
+                                   , lambda s: Spam(int(s)) )
+        try:
+            xml = serializable._field_to_xml(None, 'v', Spam(3), {})
+            self.assertEquals('spam', xml.get('type'))
+            self.assertEquals(3, serializable._xml_to_field(xml, {}, 'v').n)
+        finally:
+            del serializable._codecs_by_type[Spam]
+            del serializable._codecs_by_tag['spam']
+
+
+def add_test_data():
+    def s(o):
+        o.save()
+        return o
+
+    menu    = s(Menu(name='Breakfast'))
+    menui1  = s(MenuItem(menu=menu, name='Spam and Eggs', price=4.00))
+    menui2  = s(MenuItem(menu=menu, name='Eggs and Spam', price=4.50))
+    menui3  = s(MenuItem(menu=menu, name='Spammity Spam', price=5.00))
+    menui4  = s(MenuItem(menu=menu, name='Spam'         , price=3.00))
+    order   = s(Order(customer='Brian', date=datetime.date.today()))
+    orderi1 = s(OrderEntry(order=order, menuitem=menui1, count=1))
+    orderi2 = s(OrderEntry(order=order, menuitem=menui2, count=1))
+    orderi3 = s(OrderEntry(order=order, menuitem=menui4, count=2))
+
 
 class TestXmlSerialization(TestCase):
+    maxDiff = None
     def add_test_data(self):
-        def s(o):
-            o.save()
-            return o
-
-        menu    = s(Menu(name='Breakfast'))
-        menui1  = s(MenuItem(menu=menu, name='Spam and Eggs', price=4.00))
-        menui2  = s(MenuItem(menu=menu, name='Eggs and Spam', price=4.50))
-        menui3  = s(MenuItem(menu=menu, name='Spammity Spam', price=5.00))
-        menui4  = s(MenuItem(menu=menu, name='Spam'         , price=3.00))
-        order   = s(Order(customer='Brian', date=datetime.date.today()))
-        orderi1 = s(OrderEntry(order=order, menuitem=menui1, count=1))
-        orderi2 = s(OrderEntry(order=order, menuitem=menui2, count=1))
-        orderi3 = s(OrderEntry(order=order, menuitem=menui4, count=2))
+        add_test_data()
 
     def verify_test_data_present(self):
         self.assertEquals( 1, len(Menu      .objects.all()) )
@@ -100,6 +194,56 @@ class TestXmlSerialization(TestCase):
 
         self.verify_test_data_not_present()
 
+    def test_wipe_db_without_signals(self):
+        self.add_test_data()
+        deleted = list()
+        def on_delete(sender, **kwargs):
+            deleted.append(sender)
+        signals.pre_delete.connect(on_delete)
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                with delete_all_models_in_db.logging_filter:
+                    delete_all_models_in_db([Menu, Order], fast=True,
+                                            send_signals=False)
+        finally:
+            signals.pre_delete.disconnect(on_delete)
+
+        self.verify_test_data_not_present()
+        self.assertEquals( [], deleted )
+        self.assertEquals( ['orderentry', 'menuitem', 'menu', 'order']
+                         , [ re.search('DELETE FROM "xmldump_(\w+)"',
+                                       q['sql']).group(1)
+                             for q in queries ] )
+
+    def test_wipe_db_fast(self):
+        self.add_test_data()
+        deleted = list()
+        def on_delete(sender, instance, **kwargs):
+            deleted.append( (sender, instance.pk) )
+        signals.post_delete.connect(on_delete, sender=MenuItem)
+        try:
+            # Only the rows of classes with receivers are loaded, and
+            # nothing is loaded to look for rows to cascade to.
+            expected = list()
+            for cls in (OrderEntry, MenuItem, Menu, Order):
+                if signals.pre_delete.has_listeners(cls) or \
+                        signals.post_delete.has_listeners(cls):
+                    expected.append( ('SELECT', cls._meta.db_table) )
+                expected.append( ('DELETE', cls._meta.db_table) )
+            with CaptureQueriesContext(connection) as queries:
+                with delete_all_models_in_db.logging_filter:
+                    delete_all_models_in_db([Menu, Order], fast=True)
+        finally:
+            signals.post_delete.disconnect(on_delete, sender=MenuItem)
+
+        self.verify_test_data_not_present()
+        self.assertEquals( [ (MenuItem, pk) for pk in (1, 2, 3, 4) ]
+                         , deleted )
+        self.assertEquals( expected
+                         , [ re.search(r'(SELECT|DELETE) .*?FROM "(\w+)"',
+                                       q['sql']).groups()
+                             for q in queries ] )
+
     def test_model_to_xml_and_back(self):
         self.add_test_data()
         self.verify_test_data_present()
@@ -117,3 +261,512 @@ class TestXmlSerialization(TestCase):
         xml2 = models_to_xml([Menu])
         self.assertEquals(indent_xml(xml1), indent_xml(xml2))
 
+    def test_model_to_xml_stream(self):
+        self.add_test_data()
+
+        stream = StringIO()
+        serializable.models_to_xml_stream([Menu, Order], stream)
+        self.assertEquals( indent_xml(models_to_xml([Menu, Order]))
+                         , indent_xml(stream.getvalue()) )
+
+    def test_xml_stream_to_models(self):
+        self.add_test_data()
+        xml1 = models_to_xml([Menu, Order])
+        stream = StringIO()
+        serializable.models_to_xml_stream([Menu, Order], stream)
+
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+        self.verify_test_data_not_present()
+
+        serializable.xml_stream_to_models(StringIO(stream.getvalue()))
+        self.verify_test_data_present()
+        self.assertEquals(indent_xml(xml1), indent_xml(models_to_xml([Menu])))
+
+    def test_model_to_xml_compact(self):
+        self.add_test_data()
+        Menu.objects.create(name='Lunch, \\N or \\. ')
+        xml1 = models_to_xml([Menu, Order])
+        compact = models_to_xml([Menu, Order], compact=True)
+        self.assertEquals('compact', compact.get('format'))
+        self.assertTrue( len(ET.tostring(compact))*2
+                         < len(ET.tostring(xml1)) )
+        stream = StringIO()
+        serializable.models_to_xml_stream([Menu, Order], stream, compact=True)
+        self.assertEquals(ET.tostring(compact), stream.getvalue())
+
+        indented = ET.fromstring(indent_xml(compact))
+        for load in ( lambda: xml_to_models(indented)
+                    , lambda: xml_to_models(compact, ordered=True)
+                    , lambda: serializable.xml_stream_to_models(
+                                                StringIO(stream.getvalue()))
+                    ):
+            with delete_all_models_in_db.logging_filter:
+                delete_all_models_in_db([Menu, Order])
+            load()
+            self.assertEquals(2, Menu.objects.count())
+            self.assertEquals( indent_xml(xml1)
+                             , indent_xml(models_to_xml([Menu, Order])) )
+
+    def test_model_to_xml_compact_to_xml(self):
+        # Owned objects of a class with its own to_xml are written in the
+        # usual way, but must still be loaded as owned objects.
+        def to_xml(self, context, name):
+            path = 'xmldump.models.MenuItem'
+            node = ET.Element(name, type=path) if name else ET.Element(path)
+            for field in ('id', 'name', 'price'):
+                node.append(serializable._field_to_xml(
+                                    self, field, getattr(self, field), context))
+            node.append(serializable._etn('menu', type='reference',
+                                          to_type='xmldump.models.Menu',
+                                          text=str(self.menu_id)))
+            return node
+        MenuItem.to_xml = to_xml
+        serializable._model_plans.clear()
+        serializable._model_plans_by_path.clear()
+        try:
+            self.add_test_data()
+            xml1 = models_to_xml([Menu, Order])
+            compact = models_to_xml([Menu, Order], compact=True)
+            with delete_all_models_in_db.logging_filter:
+                delete_all_models_in_db([Menu, Order])
+            xml_to_models(ET.fromstring(indent_xml(compact)))
+            self.verify_test_data_present()
+            self.assertEquals( indent_xml(xml1)
+                             , indent_xml(models_to_xml([Menu, Order])) )
+        finally:
+            del MenuItem.to_xml
+            serializable._model_plans.clear()
+            serializable._model_plans_by_path.clear()
+
+    def test_stats(self):
+        self.add_test_data()
+        stats = serializable.SerializationStats()
+        with CaptureQueriesContext(connection) as queries:
+            xml1 = models_to_xml([Menu, Order], stats=stats)
+        report = dict( (figures['model'], figures)
+                       for figures in stats.report() )
+        self.assertEquals( [1, 4, 1, 3]
+                         , [ report['xmldump.models.' + name]['rows']
+                             for name in ('Menu', 'MenuItem', 'Order',
+                                          'OrderEntry') ] )
+        self.assertEquals( len(queries)
+                         , sum( figures['queries']
+                                for figures in report.values() ) )
+        for figures in report.values():
+            self.assertTrue( figures['seconds'] >= figures['field_seconds'] )
+        # The queries are counted without being logged.
+        self.assertFalse(connection.queries_logged)
+        del connection.queries[:]
+        models_to_xml([Menu, Order], stats=stats)
+        self.assertEquals([], connection.queries)
+        self.assertFalse('cursor' in vars(connections['default']))
+
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+        # Put the Order first, so its entries refer to MenuItems which
+        # have not been loaded yet.
+        menu, order = list(xml1)
+        xml1.remove(menu)
+        xml1.append(menu)
+        stats = serializable.SerializationStats()
+        xml_to_models(xml1, stats=stats)
+        report = dict( (figures['model'], figures)
+                       for figures in stats.report() )
+        self.assertEquals(3, report['xmldump.models.OrderEntry']['rows'])
+        self.assertEquals(3, report['xmldump.models.OrderEntry']['queries'])
+        self.assertEquals(3, report['xmldump.models.OrderEntry']['fixups'])
+        self.assertEquals(0, report['xmldump.models.Order']['fixups'])
+
+    def test_progress(self):
+        self.add_test_data()
+        calls = list()
+        def on_progress(cls, done, total):
+            calls.append( (cls.__name__, done, total) )
+        models_to_xml([Menu, Order], on_progress=on_progress,
+                      progress_every=2)
+        self.assertEquals( [ ('MenuItem', 2, 4), ('MenuItem', 4, 4)
+                           , ('OrderEntry', 2, 3)
+                           , ('Menu', 1, 1), ('Order', 1, 1)
+                           , ('OrderEntry', 3, 3) ]
+                         , calls )
+
+        for compact in (False, True):
+            xml1 = models_to_xml([Menu, Order], compact=compact)
+            with delete_all_models_in_db.logging_filter:
+                delete_all_models_in_db([Menu, Order])
+            del calls[:]
+            xml_to_models(xml1, on_progress=on_progress)
+            self.assertEquals( [ ('Menu', 1, 1), ('MenuItem', 4, 4)
+                               , ('Order', 1, 1), ('OrderEntry', 3, 3) ]
+                             , sorted(calls) )
+
+    def test_progress_cancel(self):
+        self.add_test_data()
+        xml1 = models_to_xml([Menu, Order])
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+
+        calls = list()
+        def on_progress(cls, done, total):
+            calls.append( (cls.__name__, done, total) )
+            return cls is not MenuItem
+        with self.assertRaises(serializable.SerializationCancelled):
+            xml_to_models(xml1, on_progress=on_progress, progress_every=2)
+        self.assertEquals( [('MenuItem', 2, 4)], calls )
+        self.verify_test_data_not_present()
+
+    def test_model_to_xml_query_count(self):
+        self.add_test_data()
+        with CaptureQueriesContext(connection) as small:
+            xml1 = models_to_xml([Menu, Order])
+
+        items = list(MenuItem.objects.all())
+        for i in range(20):
+            order = Order.objects.create(customer='Brian %d' % i,
+                                         date=datetime.date.today())
+            for item in items:
+                OrderEntry.objects.create(order=order, menuitem=item, count=i)
+        with CaptureQueriesContext(connection) as large:
+            xml2 = models_to_xml([Menu, Order])
+
+        self.assertEquals(len(small), len(large))
+        self.assertEquals(21, len(xml2.findall('xmldump.models.Order')))
+        self.assertEquals(87, len(xml2.findall('*/___owned/*')))
+
+    def test_xml_to_models_bulk(self):
+        self.add_test_data()
+        xml1 = models_to_xml([Menu, Order])
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+
+        with CaptureQueriesContext(connection) as queries:
+            xml_to_models(xml1, bulk=True, batch_size=2)
+        self.verify_test_data_present()
+        self.assertEquals(indent_xml(xml1), indent_xml(models_to_xml([Menu])))
+        # One insert per class and batch, but nothing per object.
+        self.assertEquals( 6, len([ q for q in queries
+                                    if 'INSERT INTO' in q['sql'] ]) )
+
+    def test_xml_to_models_forward_references(self):
+        self.add_test_data()
+        xml1 = models_to_xml([Menu, Order])
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+
+        # Put the Order first, so its entries refer to MenuItems which
+        # have not been loaded yet.
+        menu, order = list(xml1)
+        xml1.remove(menu)
+        xml1.append(menu)
+        with CaptureQueriesContext(connection) as queries:
+            xml_to_models(xml1)
+        self.verify_test_data_present()
+        self.assertEquals( [], [ q for q in queries
+                                 if 'SELECT' in q['sql'] and
+                                    'INSERT' not in q['sql'] ] )
+        self.assertEquals( [1, 2, 4]
+                         , sorted( OrderEntry.objects.values_list(
+                                        'menuitem__id', flat=True) ) )
+
+    def test_xml_to_models_ordered(self):
+        self.add_test_data()
+        xml1 = models_to_xml([Menu, Order])
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+
+        menu, order = list(xml1)
+        xml1.remove(menu)
+        xml1.append(menu)
+        with CaptureQueriesContext(connection) as queries:
+            xml_to_models(xml1, bulk=True, ordered=True)
+        self.verify_test_data_present()
+        self.assertEquals( ['order', 'menu', 'menuitem', 'orderentry']
+                         , [ re.search('INSERT INTO "xmldump_(\w+)"', q['sql'])
+                               .group(1)
+                             for q in queries if 'INSERT' in q['sql'] ] )
+
+    def test_model_to_xml_parallel(self):
+        self.add_test_data()
+        for i in range(20):
+            Order.objects.create(customer='Brian %d' % i,
+                                 date=datetime.date.today())
+        xml1 = models_to_xml([Menu, Order])
+
+        for chunks in (1, 3):
+            stream = StringIO()
+            serializable.models_to_xml_parallel([Menu, Order], stream,
+                                                processes=0, chunks=chunks)
+            self.assertEquals(indent_xml(xml1), indent_xml(stream.getvalue()))
+
+    def test_model_to_xml_parallel_referred_to(self):
+        self.add_test_data()
+        # The MenuItems and Menus are only reached through a ForeignKey.
+        stream = StringIO()
+        serializable.models_to_xml_parallel([Order], stream, processes=0,
+                                            include_rest_of_app=False)
+        xml1 = ET.fromstring(stream.getvalue())
+        self.assertEquals( ['xmldump.models.Order', 'xmldump.models.Menu']
+                         , [ x.tag for x in xml1 ] )
+
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+        xml_to_models(xml1)
+        self.verify_test_data_present()
+
+    def test_xml_to_models_parallel(self):
+        self.add_test_data()
+        xml1 = models_to_xml([Menu, Order])
+        compact = ET.tostring(models_to_xml([Menu, Order], compact=True))
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+
+        menu, order = list(xml1)
+        xml1.remove(menu)
+        xml1.append(menu)
+        # The workers do not use the db, so the pool can be used with the
+        # test db.
+        for source,processes in ( (indent_xml(xml1), 0)
+                                , (StringIO(compact), 2) ):
+            serializable.xml_to_models_parallel(source, processes=processes,
+                                                batch_size=1)
+            self.verify_test_data_present()
+            self.assertEquals( [1, 2, 4]
+                             , sorted( OrderEntry.objects.values_list(
+                                            'menuitem__id', flat=True) ) )
+            with delete_all_models_in_db.logging_filter:
+                delete_all_models_in_db([Menu, Order])
+
+    def test_top_level_slices(self):
+        text = ( '<?xml version="1.0" ?><!-- <a> --><r x=">">'
+                 '<a y=\'/>\'><b/><![CDATA[</a>]]></a>\n<c/><d></d></r>' )
+        self.assertEquals( [ '<a y=\'/>\'><b/><![CDATA[</a>]]></a>'
+                           , '<c/>', '<d></d>' ]
+                         , [ text[start:end] for start,end in
+                             serializable._top_level_slices(text) ] )
+
+    def test_model_to_xml_delta(self):
+        self.add_test_data()
+        xml1, manifest = serializable.models_to_xml_delta([Menu, Order])
+        self.assertEquals( 9, len(xml1) )
+
+        item = MenuItem.objects.get(name='Spam')
+        item.price = 3.25
+        item.save()
+        Order.objects.create(customer='Arthur', date=datetime.date.today())
+        OrderEntry.objects.get(id=2).delete()
+
+        for timestamp_fields in (None, {Order:'date'}):
+            xml2, manifest2 = serializable.models_to_xml_delta(
+                                [Menu, Order], manifest, timestamp_fields)
+            self.assertEquals( [ ('xmldump.models.Order', '2')
+                               , ('xmldump.models.MenuItem', '4')
+                               , ('___deleted', '2')
+                               ]
+                             , [ (x.tag, x.findtext('id', x.text))
+                                 for x in xml2 ] )
+            self.assertEquals( 'xmldump.models.OrderEntry'
+                             , xml2[2].get('to_type') )
+            self.assertEquals( 'reference', xml2[1].find('menu').get('type') )
+
+        xml3, manifest3 = serializable.models_to_xml_delta([Menu, Order],
+                                                           manifest2)
+        self.assertEquals( 0, len(xml3) )
+
+    def test_model_to_xml_delta_json_manifest(self):
+        for timestamp_fields in (None, {Order:'date'}):
+            with delete_all_models_in_db.logging_filter:
+                delete_all_models_in_db([Menu, Order])
+            self.add_test_data()
+            xml1, manifest = serializable.models_to_xml_delta(
+                                [Menu, Order], None, timestamp_fields)
+            manifest = json.loads(json.dumps(manifest))
+            xml2, manifest = serializable.models_to_xml_delta(
+                                [Menu, Order], manifest, timestamp_fields)
+            self.assertEquals( 0, len(xml2) )
+
+            # Changed on the day of the last export.
+            order = Order.objects.get(customer='Brian')
+            order.customer = 'Arthur'
+            order.save()
+            entries = list(OrderEntry.objects.order_by('id')
+                                             .values_list('id', flat=True))
+            OrderEntry.objects.get(id=entries[1]).delete()
+            manifest = json.loads(json.dumps(manifest))
+            xml3, manifest = serializable.models_to_xml_delta(
+                                [Menu, Order], manifest, timestamp_fields)
+            self.assertEquals( [ ('xmldump.models.Order', str(order.id))
+                               , ('___deleted', str(entries[1]))
+                               ]
+                             , [ (x.tag, x.findtext('id', x.text))
+                                 for x in xml3 ] )
+
+            xml_to_models(xml1, mode='merge')
+            self.assertEquals( 3, OrderEntry.objects.count() )
+            xml_to_models(xml3, mode='merge')
+            self.assertEquals( [entries[0], entries[2]], sorted(
+                    OrderEntry.objects.values_list('id', flat=True) ) )
+            self.assertEquals( 4, MenuItem.objects.count() )
+            self.assertEquals( ['Arthur'], [ o.customer for o in
+                                             Order.objects.all() ] )
+
+    def test_xml_to_models_merge(self):
+        self.add_test_data()
+        xml1 = models_to_xml([Menu, Order])
+
+        item = MenuItem.objects.get(name='Spam')
+        item.price = 3.25
+        item.save()
+        Order.objects.create(customer='Arthur', date=datetime.date.today())
+        OrderEntry.objects.get(id=2).delete()
+
+        with CaptureQueriesContext(connection) as queries:
+            xml_to_models(xml1, mode='merge')
+        self.assertEquals( 1, len([ q for q in queries
+                                    if 'UPDATE' in q['sql'] ]) )
+        self.assertEquals( 1, len([ q for q in queries
+                                    if 'INSERT' in q['sql'] ]) )
+        self.assertEquals( 3.0, MenuItem.objects.get(name='Spam').price )
+        self.assertEquals( 2, Order.objects.count() )
+
+        xml_to_models(xml1, mode='merge', delete_missing=True)
+        self.verify_test_data_present()
+
+    def test_xml_to_models_merge_unchanged(self):
+        self.add_test_data()
+        MenuItem.objects.filter(name='Spam').update(price=1.2345678901234)
+        xml1 = models_to_xml([Menu, Order])
+        for compact in (False, True):
+            with CaptureQueriesContext(connection) as queries:
+                xml_to_models(models_to_xml([Menu, Order], compact=compact),
+                              mode='merge')
+            self.assertEquals( [], [ q for q in queries
+                                     if 'UPDATE' in q['sql'] ] )
+            self.assertEquals( indent_xml(xml1)
+                             , indent_xml(models_to_xml([Menu, Order])) )
+
+    def test_xml_to_models_merge_delete_missing_roots(self):
+        self.add_test_data()
+        menu_xml = ET.Element('ModelData')
+        menu_xml.append(models_to_xml([Menu], include_rest_of_app=False)[0])
+        del menu_xml[0][2]      # The ___owned MenuItems.
+        xml_to_models(menu_xml, mode='merge', delete_missing=[Menu, Order])
+        self.assertEquals( [1, 0, 0, 0], [ cls.objects.count() for cls in
+                                           (Menu, MenuItem, Order, OrderEntry) ] )
+
+        xml_to_models(ET.Element('ModelData'), mode='merge',
+                      delete_missing=[Menu, Order])
+        self.verify_test_data_not_present()
+
+    def test_xml_to_models_merge_delta(self):
+        self.add_test_data()
+        xml1, manifest = serializable.models_to_xml_delta([Menu, Order])
+        OrderEntry.objects.get(id=2).delete()
+        xml2, manifest = serializable.models_to_xml_delta([Menu, Order],
+                                                          manifest)
+        OrderEntry.objects.all().delete()
+        xml_to_models(xml1, mode='merge')
+        self.assertEquals( 3, OrderEntry.objects.count() )
+        xml_to_models(xml2, mode='merge')
+        self.assertEquals( [1, 3], sorted( OrderEntry.objects.values_list(
+                                                    'id', flat=True) ) )
+
+    def test_model_to_xml_subgraph(self):
+        self.add_test_data()
+        lunch = Menu.objects.create(name='Lunch')
+        chips = MenuItem.objects.create(menu=lunch, name='Chips', price=1.0)
+        order = Order.objects.create(customer='Arthur',
+                                     date=datetime.date.today())
+        OrderEntry.objects.create(order=order, menuitem=chips, count=1)
+
+        for roots in ( [Order.objects.filter(customer='Brian')]
+                     , [(Order, [1])] ):
+            with CaptureQueriesContext(connection) as queries:
+                xml = serializable.models_to_xml_subgraph(roots)
+            # The orders, their entries (with their items), and the menus.
+            self.assertEquals( 3, len(queries) )
+            self.assertEquals( ['xmldump.models.Order']
+                             , [ x.tag for x in xml ] )
+            self.assertEquals( [1, 2, 3], [ int(x.findtext('id')) for x in
+                                   xml.iter('xmldump.models.OrderEntry') ] )
+            # Referred to objects are written where they are first met.
+            def ids(tag):
+                return sorted( int(x.findtext('id')) for x in xml.iter()
+                               if tag in (x.tag, x.get('type')) )
+            self.assertEquals( [1, 2, 4], ids('xmldump.models.MenuItem') )
+            self.assertEquals( [1], ids('xmldump.models.Menu') )
+
+        compact = serializable.models_to_xml_subgraph(roots, compact=True)
+        with delete_all_models_in_db.logging_filter:
+            delete_all_models_in_db([Menu, Order])
+        xml_to_models(compact)
+        self.assertEquals( [1, 2, 4], sorted( MenuItem.objects.values_list(
+                                                    'id', flat=True) ) )
+        self.assertEquals( 3, OrderEntry.objects.count() )
+        self.assertEquals( ['Brian'], [ o.customer for o in
+                                        Order.objects.all() ] )
+
+
+class TestDeepNesting(TestCase):
+    def setUp(self):
+        with connection.schema_editor() as editor:
+            editor.create_model(Node)
+        # Each Node comes before its parent, so the parent is written in
+        # place of the ForeignKey, and so on up the chain.
+        n = sys.getrecursionlimit() + 100
+        Node.objects.bulk_create( [ Node(id=pk, parent_id=pk+1 if pk < n
+                                                          else None)
+                                    for pk in xrange(1, n+1) ] )
+        self.parents = list(Node.objects.order_by('id')
+                                        .values_list('id', 'parent_id'))
+
+    def test_deep_nesting(self):
+        xml = models_to_xml([Node], include_rest_of_app=False)
+        self.assertEquals(1, len(xml))
+        stream = StringIO()
+        serializable.models_to_xml_stream([Node], stream,
+                                          include_rest_of_app=False)
+        text = stream.getvalue()
+        stream = StringIO()
+        serializable.models_to_xml_stream([Node], stream,
+                                          include_rest_of_app=False,
+                                          compact=True)
+        compact = stream.getvalue()
+        indented = indent_xml(text)
+        self.assertEquals(indented, indent_xml(xml))
+
+        for load in ( lambda: xml_to_models(ET.fromstring(text))
+                    , lambda: xml_to_models(ET.fromstring(text), ordered=True)
+                    , lambda: xml_to_models(ET.fromstring(compact), bulk=True)
+                    , lambda: serializable.xml_stream_to_models(
+                                                        StringIO(indented))
+                    , lambda: serializable.xml_to_models_parallel(
+                                                        compact, processes=0)
+                    ):
+            with delete_all_models_in_db.logging_filter:
+                delete_all_models_in_db([Node], fast=True, send_signals=False)
+            load()
+            self.assertEquals( self.parents
+                             , list(Node.objects.order_by('id')
+                                    .values_list('id', 'parent_id')) )
+
+
+class TestParallelExport(TransactionTestCase):
+    # The workers have their own connections, so the data is committed
+    # rather than left in a test transaction, and the test db is a file.
+    def test_model_to_xml_parallel_pool(self):
+        add_test_data()
+        for i in range(20):
+            Order.objects.create(customer='Brian %d' % i,
+                                 date=datetime.date.today())
+        xml1 = models_to_xml([Menu, Order])
+
+        stream = StringIO()
+        serializable.models_to_xml_parallel([Menu, Order], stream,
+                                            processes=2, chunks=3)
+        self.assertEquals(indent_xml(xml1), indent_xml(stream.getvalue()))
+
+        with transaction.atomic():
+            self.assertRaises( AssertionError
+                             , serializable.models_to_xml_parallel
+                             , [Menu, Order], StringIO(), processes=2 )
@@ -1,3 +1,137 @@
-from django.test import TestCase
+import datetime
+import gzip
+import json
+from StringIO import StringIO
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+
+from serializable import models_to_xml
+from utils import indent_xml
+from xmldump.management.commands.benchmark import run_benchmark
+from xmldump.models import Menu, MenuItem, Order, OrderEntry
+from xmldump import views
+
+
+class TestBenchmark(TransactionTestCase):
+    # The steps are run in child processes, which need the data to be
+    # committed.
+    def test_run_benchmark(self):
+        results = list(run_benchmark(300))
+        self.assertEquals( [ 'models_to_xml', 'indent_xml'
+                           , 'delete_all_models_in_db', 'xml_to_models' ]
+                         , [ r['operation'] for r in results ] )
+        rows = sum( cls.objects.count() for cls in
+                    (Menu, MenuItem, Order, OrderEntry) )
+        self.assertEquals(rows, results[0]['rows'])
+        self.assertTrue(290 < rows <= 300)
+        self.assertTrue(results[0]['bytes'] > 0)
+        self.assertTrue(results[0]['queries'] > 0)
+        self.assertTrue( all( r['peak_rss_kb'] > 0 for r in results ) )
+
+
+class TestIndexView(TestCase):
+    def setUp(self):
+        # Rolling back the previous test's changes sends no signals.
+        cache.clear()
+        # The test db cannot be seen from other threads.
+        self.threaded = views._load_jobs.threaded
+        views._load_jobs.threaded = False
+
+    def tearDown(self):
+        views._load_jobs.threaded = self.threaded
+
+    def test_conditional_get(self):
+        response = self.client.get('/xmldump/')
+        self.assertEquals(200, response.status_code)
+        etag = response['ETag']
+
+        response = self.client.get('/xmldump/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(304, response.status_code)
+        self.assertEquals(etag, response['ETag'])
+        response = self.client.get( '/xmldump/', HTTP_IF_MODIFIED_SINCE=
+                                                 response['Last-Modified'] )
+        self.assertEquals(304, response.status_code)
+
+        Menu.objects.create(name='Lunch')
+        response = self.client.get('/xmldump/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(200, response.status_code)
+        self.assertNotEquals(etag, response['ETag'])
+        self.assertTrue('Lunch' in response.content)
+
+    def test_change_while_dumping(self):
+        # A change made while the dump is being made must not leave the
+        # older dump cached.
+        models_to_xml = views.models_to_xml
+        def change_then_dump(*args):
+            xml = models_to_xml(*args)
+            Menu.objects.create(name='Lunch')
+            return xml
+        views.models_to_xml = change_then_dump
+        try:
+            self.assertFalse('Lunch' in views._dump()['xml'])
+        finally:
+            views.models_to_xml = models_to_xml
+        self.assertTrue('Lunch' in views._dump()['xml'])
+
+    def test_load_xml_job(self):
+        Order.objects.create(customer='Brian', date=datetime.date.today())
+        etag = self.client.get('/xmldump/')['ETag']
+        response = self.client.post('/xmldump/', {'cmd': 'Load XML',
+            'xml': '<ModelData><xmldump.models.Menu><id type="int">5</id>'
+                   '<name type="unicode">Tea</name>'
+                   '</xmldump.models.Menu></ModelData>'})
+        self.assertEquals(200, response.status_code)
+        job = response.context['job']
+        self.assertEquals( 'queued'
+                         , json.loads(self.client.get(
+                                '/xmldump/jobs/%s/' % job.id).content)['state'] )
+
+        views._load_jobs.run_pending()
+        status = json.loads(self.client.get('/xmldump/jobs/%s/' % job.id)
+                                                                .content)
+        self.assertEquals('done', status['state'])
+        self.assertEquals( {'xmldump.models.Menu': {'done': 1, 'total': 1}}
+                         , status['counts'] )
+        response = self.client.get('/xmldump/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(200, response.status_code)
+        self.assertTrue('Tea' in response.content)
+        # The xml replaces everything, not just the classes in it.
+        self.assertEquals( ['Tea'], [ m.name for m in Menu.objects.all() ] )
+        self.assertEquals( 0, Order.objects.count() )
+
+        self.assertEquals(404, self.client.get('/xmldump/jobs/999/')
+                                                            .status_code)
+
+    def test_load_xml_job_without_ids(self):
+        Menu.objects.create(name='Lunch')
+        response = self.client.post('/xmldump/', {'cmd': 'Load XML',
+            'xml': '<ModelData><xmldump.models.Menu>'
+                   '<name type="unicode">Tea</name>'
+                   '</xmldump.models.Menu><xmldump.models.Menu>'
+                   '<name type="unicode">Supper</name>'
+                   '</xmldump.models.Menu></ModelData>'})
+        job = response.context['job']
+        views._load_jobs.run_pending()
+        status = json.loads(self.client.get('/xmldump/jobs/%s/' % job.id)
+                                                                .content)
+        self.assertEquals('done', status['state'])
+        self.assertEquals( ['Supper', 'Tea']
+                         , sorted( m.name for m in Menu.objects.all() ) )
+
+    def test_download(self):
+        Menu.objects.create(name='Lunch')
+        response = self.client.get('/xmldump/download/')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        xml = ''.join(response.streaming_content)
+        self.assertEquals( indent_xml(models_to_xml([Menu, Order]))
+                         , indent_xml(xml) )
+
+        response = self.client.get( '/xmldump/download/?compact=1'
+                                  , HTTP_ACCEPT_ENCODING='gzip, deflate' )
+        self.assertEquals('gzip', response['Content-Encoding'])
+        compressed = ''.join(response.streaming_content)
+        xml = gzip.GzipFile(fileobj=StringIO(compressed)).read()
+        self.assertEquals( indent_xml(models_to_xml([Menu, Order],
+                                                    compact=True))
+                         , indent_xml(xml) )
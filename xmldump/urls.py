@@ -6,5 +6,8 @@ import views
 
 urlpatterns = patterns(''
               , url(r'^$', views.index, name='index')
+              , url(r'^download/$', views.download, name='download')
+              , url(r'^jobs/(?P<job_id>\d+)/$', views.job_status,
+                    name='job_status')
               )
 
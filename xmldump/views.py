@@ -1,20 +1,113 @@
 
 import datetime
+import hashlib
 import logging
+import re
+import time
+import zlib
 from   xml.etree import ElementTree as ET
 
+from   django.core.cache import cache
+from   django.db.models import signals
+from   django.dispatch import receiver
+from   django.http import Http404, HttpResponseNotModified, JsonResponse, \
+                        StreamingHttpResponse
 from   django.shortcuts import render
+from   django.utils.http import http_date, parse_etags, parse_http_date_safe, \
+                               quote_etag
 
-from   serializable import models_to_xml, xml_to_models, delete_all_models_in_db
+from   serializable import models_to_xml, models_to_xml_chunks, \
+                          xml_to_models, delete_all_models_in_db
+from   jobs import JobQueue
 from   models import Menu, Order, MenuItem, OrderEntry
 from   test_serializable import indent_xml
 
 
+# The indented dump is kept in the cache until one of these models
+# changes. The cache is used, rather than a global, so that with a
+# shared cache backend every process sees the invalidation. The dump is
+# stored under the generation it was made in, and a change starts a new
+# generation, so a dump that was being made while the change happened
+# is never served.
+_DUMP_CACHE_KEY      = 'xmldump.views.dump'
+_DUMP_GENERATION_KEY = 'xmldump.views.dump_generation'
+_DUMP_MODELS         = (Menu, MenuItem, Order, OrderEntry)
+
+
+@receiver(signals.post_save, dispatch_uid='xmldump.views.post_save')
+@receiver(signals.post_delete, dispatch_uid='xmldump.views.post_delete')
+def _invalidate_dump(sender, **kwargs):
+    if sender in _DUMP_MODELS:
+        _new_dump_generation()
+
+
+def _new_dump_generation():
+    try:
+        cache.incr(_DUMP_GENERATION_KEY)
+    except ValueError:
+        _dump_generation()  # It was not set, or was evicted.
+
+
+def _dump_generation():
+    generation = cache.get(_DUMP_GENERATION_KEY)
+    if generation is None:
+        # Start from the time, so that if the counter was evicted the
+        # generations of the dumps that are still cached are not reused.
+        cache.add(_DUMP_GENERATION_KEY, int(time.time() * 1000), None)
+        generation = cache.get(_DUMP_GENERATION_KEY)
+    return generation
+
+
+def _dump():
+    '''Return a dict with the indented xml of the db, its etag and the
+    time it was made.'''
+    generation = _dump_generation()
+    key = '%s.%d' % (_DUMP_CACHE_KEY, generation)
+    dump = cache.get(key)
+    if dump is None:
+        xml = indent_xml( models_to_xml([Menu, Order]) )
+        dump = dict( xml           = xml
+                   , etag          = hashlib.md5(
+                                        xml.encode('utf-8')).hexdigest()
+                   , last_modified = int(time.time())
+                   )
+        if cache.get(_DUMP_GENERATION_KEY) == generation:
+            cache.set(key, dump, None)
+    return dump
+
+
+def _not_modified(request, dump):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return dump['etag'] in etags or '*' in etags
+    if_modified_since = parse_http_date_safe(
+                            request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return if_modified_since is not None and \
+           dump['last_modified'] <= if_modified_since
+
+
+# Loads are run in the background, as large ones take longer than a
+# request is allowed to.
+_load_jobs = JobQueue()
+_LOAD_PROGRESS_EVERY = 500
+
+
+def _load_xml_job(data):
+    def load(job):
+        xml_to_models(ET.fromstring(data), mode='merge',
+                      delete_missing=[Menu, Order],
+                      on_progress=job.on_progress,
+                      progress_every=_LOAD_PROGRESS_EVERY)
+        _new_dump_generation()
+    return load
+
+
 def index(request):
+    job = None
     if request.POST.get('cmd') == 'Load XML':
-        delete_all_models_in_db([Menu,Order])
-        xml = ET.fromstring(request.POST['xml'])
-        xml_to_models(xml)
+        job = _load_jobs.submit(
+                    _load_xml_job(request.POST['xml'].encode('utf-8')))
     elif request.POST.get('cmd') == 'Clear XML':
         delete_all_models_in_db([Menu,Order])
     elif request.POST.get('cmd') == 'Default XML':
@@ -34,11 +127,57 @@ def index(request):
         pass
     else:
         raise Exception('Unrecognized command')
+    if request.method == 'POST':
+        # Bulk loads and deletes do not send signals.
+        _new_dump_generation()
+
+    dump = _dump()
+    if request.method in ('GET', 'HEAD') and _not_modified(request, dump):
+        response = HttpResponseNotModified()
+    else:
+        context = dict( xml = dump['xml']
+                      , job = job
+                      )
+        response = render(request, 'xmldump/xmldump.html', context)
+    response['ETag'] = quote_etag(dump['etag'])
+    response['Last-Modified'] = http_date(dump['last_modified'])
+    return response
+
+
+
+def job_status(request, job_id):
+    '''Report the state of a load started by index, as json.'''
+    job = _load_jobs.get(job_id)
+    if job is None:
+        raise Http404('No such job.')
+    return JsonResponse(job.status())
 
-    xml = indent_xml( models_to_xml([Menu, Order]) )
+_ACCEPTS_GZIP = re.compile(r'\bgzip\b')
 
-    context = dict( xml = xml
-                  )
+def download(request):
+    '''Stream the dump as an xml file, exporting it as it is sent.
+    It is gzipped if the client accepts that, unless gzip=0 is given.
+    compact=1 asks for the compact format.'''
+    chunks = models_to_xml_chunks([Menu, Order],
+                                  compact=request.GET.get('compact') == '1')
+    gzip = ( request.GET.get('gzip') != '0' and
+             _ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING',
+                                                   '')) )
+    if gzip:
+        chunks = _gzip_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type='application/xml')
+    response['Content-Disposition'] = 'attachment; filename="dump.xml"'
+    response['Vary'] = 'Accept-Encoding'
+    if gzip:
+        response['Content-Encoding'] = 'gzip'
+    return response
 
-    return render(request, 'xmldump/xmldump.html', context)
 
+def _gzip_chunks(chunks):
+    # 16 + MAX_WBITS makes zlib write a gzip header and trailer.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()